@@ -0,0 +1,427 @@
+import argparse
+import base64
+import hashlib
+import http.server
+import json
+import random
+import re
+import string
+import threading
+import time
+import tracemalloc
+import google_crc32c
+from google.cloud import bigquery
+
+import run
+
+RESUMABLE_ALIGNMENT = 256 * 1024 # GCS requires non-final chunks to be a multiple of 256 KiB
+MEMORY_NOISE_MB = 1 # growth in peak memory that is never reported as a regression
+UNICODE_CHARACTERS = 'áéíóúñüçßøåæœ€東京大阪한국어Привет😀🎉'
+
+class ResumableUploadHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Handles PUT requests the way the GCS resumable upload protocol does: chunks carry a Content-Range,
+    incomplete uploads get a 308 with the committed Range, and a 'bytes */total' request reports status.
+    Requests without a Content-Range are single-shot uploads. Completed uploads report the stored size and
+    hashes, and an upload whose x-goog-hash doesn't match what was stored is rejected with a 400.
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_status(self, status_code: int, headers: dict = None):
+        self.send_response(status_code)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_committed(self, upload: dict):
+        if upload['total_size'] is not None and upload['committed'] == upload['total_size']:
+            self.send_status(200, get_stored_headers(upload))
+        elif upload['committed']:
+            self.send_status(308, {'Range': f'bytes=0-{upload["committed"] - 1}'})
+        else:
+            self.send_status(308)
+
+    def do_PUT(self):
+        server = self.server
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if server.mb_per_second:
+            time.sleep(len(body) / (1024 * 1024) / server.mb_per_second)
+        with server.lock:
+            server.request_count += 1
+            if server.fail_every and server.request_count % server.fail_every == 0:
+                self.send_status(503)
+                return
+            upload = server.uploads.setdefault(self.path, create_upload())
+            upload['headers'].append(dict(self.headers))
+
+            content_range = self.headers.get('Content-Range')
+            server.requests.append((self.path, content_range))
+            if content_range is None:
+                body = server.corrupt(body, 0)
+                upload.update(create_upload(), headers=upload['headers'])
+                upload['data'][:] = body
+                upload['crc32c'].update(body)
+                upload['md5'].update(body)
+                upload['committed'] = upload['total_size'] = len(body)
+                self.send_status(200, get_stored_headers(upload))
+                return
+
+            status_match = re.match(r'bytes \*/(\d+|\*)', content_range)
+            if status_match:
+                self.send_committed(upload)
+                return
+
+            start_byte, end_byte, total_size = re.match(r'bytes (\d+)-(\d+)/(\d+|\*)', content_range).groups()
+            start_byte, end_byte = int(start_byte), int(end_byte)
+            if total_size != '*':
+                upload['total_size'] = int(total_size)
+            is_final = upload['total_size'] is not None and end_byte + 1 == upload['total_size']
+            if not is_final and len(body) % RESUMABLE_ALIGNMENT and server.strict_alignment:
+                self.send_status(400)
+                return
+            if start_byte > upload['committed']:
+                # the server never accepts a gap, the client has to resend from the committed offset
+                self.send_committed(upload)
+                return
+
+            new_data = body[upload['committed'] - start_byte:]
+            if server.partial_commit and not is_final and len(new_data) > RESUMABLE_ALIGNMENT:
+                # keep only part of the chunk, as GCS may do, the client has to resend the rest
+                new_data = new_data[:len(new_data) // 2 // RESUMABLE_ALIGNMENT * RESUMABLE_ALIGNMENT]
+            new_data = server.corrupt(new_data, upload['committed'])
+            if server.keep_data:
+                upload['data'] += new_data
+            upload['crc32c'].update(new_data)
+            upload['md5'].update(new_data)
+            upload['committed'] += len(new_data)
+            expected_hashes = run.parse_hash_header(self.headers.get('x-goog-hash', ''))
+            stored_hashes = run.parse_hash_header(get_stored_headers(upload)['x-goog-hash'])
+            if is_final and any(stored_hashes[name] != value for name, value in expected_hashes.items()):
+                self.send_status(400)
+                return
+            self.send_committed(upload)
+
+def create_upload() -> dict:
+    return {
+        'committed': 0,
+        'total_size': None,
+        'data': bytearray(),
+        'headers': [],
+        'crc32c': google_crc32c.Checksum(),
+        'md5': hashlib.md5()
+    }
+
+def get_stored_headers(upload: dict) -> dict:
+    """
+    Size and hashes of a completed upload, as GCS reports them for the stored object
+    """
+    crc32c = base64.b64encode(upload['crc32c'].digest()).decode('ascii')
+    md5 = base64.b64encode(upload['md5'].digest()).decode('ascii')
+    return {'x-goog-stored-content-length': str(upload['committed']), 'x-goog-hash': f'crc32c={crc32c},md5={md5}'}
+
+class ResumableUploadServer(http.server.ThreadingHTTPServer):
+    """
+    Local stand-in for the MIG landing bucket. fail_every returns a 503 for every nth request and
+    partial_commit only commits part of each non-final chunk, to exercise retries and realignment.
+    mb_per_second limits how fast request bodies are accepted, to simulate the network.
+    corrupt_byte flips the byte at that offset of every upload, as if it was damaged on the way.
+    """
+    daemon_threads = True
+
+    def __init__(
+        self,
+        keep_data: bool = True,
+        strict_alignment: bool = False,
+        fail_every: int = 0,
+        partial_commit: bool = False,
+        mb_per_second: float = 0,
+        corrupt_byte: int = None):
+        super().__init__(('127.0.0.1', 0), ResumableUploadHandler)
+        self.mb_per_second = mb_per_second
+        self.keep_data = keep_data
+        self.strict_alignment = strict_alignment
+        self.fail_every = fail_every
+        self.partial_commit = partial_commit
+        self.corrupt_byte = corrupt_byte
+        self.lock = threading.Lock()
+        self.uploads = {}
+        self.requests = []
+        self.request_count = 0
+
+    def corrupt(self, data: bytes, start_byte: int) -> bytes:
+        if self.corrupt_byte is None or not start_byte <= self.corrupt_byte < start_byte + len(data):
+            return data
+        data = bytearray(data)
+        data[self.corrupt_byte - start_byte] ^= 0xff
+        return bytes(data)
+
+    def get_upload_url(self, name: str) -> dict:
+        return {'url': f'http://127.0.0.1:{self.server_port}/upload/{name}'}
+
+    def get_upload(self, name: str) -> dict:
+        return self.uploads[f'/upload/{name}']
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+
+class FakeRowIterator:
+    def __init__(self, json_rows: list[str], page_latency: float = 0):
+        self.json_rows = json_rows
+        self.total_rows = len(json_rows)
+        self.schema = [bigquery.SchemaField('json', 'STRING')]
+        self.page_latency = page_latency
+
+    def __iter__(self):
+        field_to_index = {'json': 0}
+        for row_index, json_row in enumerate(self.json_rows):
+            if self.page_latency and row_index % run.READ_PAGE_ROWS == 0:
+                time.sleep(self.page_latency)
+            yield bigquery.Row((json_row,), field_to_index)
+
+class FakeQueryJob:
+    def __init__(self, json_rows: list[str], page_latency: float = 0):
+        self.json_rows = json_rows
+        self.page_latency = page_latency
+        self.destination = 'benchmark.query_results'
+
+    def result(self) -> FakeRowIterator:
+        return FakeRowIterator(self.json_rows, self.page_latency)
+
+class FakeBigQueryClient:
+    """
+    Stand-in for bigquery.Client that answers every query with the same rows, already serialized
+    with TO_JSON_STRING as BigQuery would return them. page_latency is the time each page of
+    READ_PAGE_ROWS rows takes to arrive, which is what parallel reads hide.
+    """
+    def __init__(self, json_rows: list[str], page_latency: float = 0, schema: list[bigquery.SchemaField] = None):
+        self.json_rows = json_rows
+        self.page_latency = page_latency
+        self.schema = schema or []
+
+    def get_table(self, table: str) -> bigquery.Table:
+        source_table = bigquery.Table(f'project.{table}', self.schema)
+        source_table._properties['numRows'] = str(len(self.json_rows))
+        return source_table
+
+    def query(self, sql: str, job_config: bigquery.QueryJobConfig = None) -> FakeQueryJob:
+        return FakeQueryJob(self.json_rows, self.page_latency)
+
+    def list_rows(
+        self,
+        table: str,
+        selected_fields: list = None,
+        start_index: int = 0,
+        max_results: int = None) -> FakeRowIterator:
+        return FakeRowIterator(self.json_rows[start_index:start_index + max_results], self.page_latency)
+
+def generate_json_rows(row_count: int, column_count: int, unicode_ratio: float = 0.0, seed: int = 0) -> list[str]:
+    """
+    Synthetic table rows, one id column then string, integer and float columns in turn.
+    unicode_ratio is the share of string values that include non-ASCII characters.
+    """
+    generator = random.Random(seed)
+    rows = []
+    for row_index in range(row_count):
+        row = {'id': row_index}
+        for column_index in range(1, column_count):
+            column_kind = column_index % 3
+            if column_kind == 1:
+                value = ''.join(generator.choices(string.ascii_letters + ' ,"', k=generator.randint(4, 24)))
+                if generator.random() < unicode_ratio:
+                    value += ''.join(generator.choices(UNICODE_CHARACTERS, k=4))
+            elif column_kind == 2:
+                value = generator.randint(-10 ** 9, 10 ** 9)
+            else:
+                value = round(generator.uniform(-1000, 1000), 4)
+            row[f'column_{column_index}'] = value
+        rows.append(json.dumps(row, ensure_ascii=False))
+    return rows
+
+def get_synthetic_schema(column_count: int) -> list[bigquery.SchemaField]:
+    """
+    BigQuery schema of the rows made by generate_json_rows
+    """
+    column_types = {0: 'FLOAT64', 1: 'STRING', 2: 'INT64'}
+    return [bigquery.SchemaField('id', 'INT64', 'REQUIRED')] + [
+        bigquery.SchemaField(f'column_{column_index}', column_types[column_index % 3])
+        for column_index in range(1, column_count)
+    ]
+
+def measure_stage(name: str, stage_function, row_count: int, trace_memory: bool = True) -> tuple[dict, object]:
+    """
+    Run one stage of the pipeline, returning its metrics and the stage result.
+    Stages return the number of bytes they produced or sent along with their result.
+    peak_mb is the most python memory the stage allocated on top of what earlier stages left behind,
+    so each stage is measured on its own. It is None when memory isn't traced.
+    """
+    if trace_memory:
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+    start_time = time.perf_counter()
+    byte_count, result = stage_function()
+    seconds = time.perf_counter() - start_time
+    peak_mb = None
+    if trace_memory:
+        peak_mb = round((tracemalloc.get_traced_memory()[1] - start_memory) / (1024 * 1024), 1)
+    metrics = {
+        'stage': name,
+        'seconds': round(seconds, 4),
+        'rows_per_second': round(row_count / seconds, 1) if seconds else None,
+        'mb_per_second': round(byte_count / (1024 * 1024) / seconds, 2) if seconds else None,
+        'bytes': byte_count,
+        'peak_mb': peak_mb
+    }
+    return metrics, result
+
+def run_benchmark(
+    row_count: int,
+    column_count: int,
+    unicode_ratio: float = 0.0,
+    chunk_size: int = RESUMABLE_ALIGNMENT * 4,
+    compression: str = None,
+    trace_memory: bool = True,
+    read_streams: int = 1,
+    page_latency: float = 0,
+    adaptive_chunks: bool = False,
+    upload_mb_per_second: float = 0) -> list[dict]:
+    """
+    Push a synthetic table through fetch, encode and chunked upload, then through the streaming pipeline
+    """
+    json_rows = generate_json_rows(row_count, column_count, unicode_ratio)
+    client = FakeBigQueryClient(json_rows, page_latency, get_synthetic_schema(column_count))
+    results = []
+    if trace_memory:
+        tracemalloc.start()
+
+    with ResumableUploadServer(keep_data=False, strict_alignment=True, mb_per_second=upload_mb_per_second) as server:
+        def fetch():
+            source_data = run.get_source_data(client, 'benchmark', 'synthetic_table', read_streams)
+            return sum(len(json_row) for json_row in json_rows), source_data
+        metrics, source_data = measure_stage('fetch', fetch, row_count, trace_memory)
+        results.append(metrics)
+
+        def encode():
+            fields = run.get_source_fields(client, 'benchmark', 'synthetic_table')
+            data_buffer = run.create_data_buffer(source_data, compression=compression, fields=fields)
+            return data_buffer.size, data_buffer
+        metrics, data_buffer = measure_stage('encode', encode, row_count, trace_memory)
+        results.append(metrics)
+        del source_data
+
+        def upload():
+            upload_url = server.get_upload_url('chunked')
+            with data_buffer:
+                run.write_chunked_data(
+                    data_buffer,
+                    data_buffer.size,
+                    upload_url,
+                    chunk_size,
+                    compression=compression,
+                    chunk_sizer=run.ChunkSizer(chunk_size, adaptive_chunks)
+                )
+            return server.get_upload('chunked')['committed'], None
+        metrics, _ = measure_stage('upload', upload, row_count, trace_memory)
+        results.append(metrics)
+
+        def stream():
+            # the same pipeline as --streaming, encoding the next chunk while the current one uploads
+            chunk_sizer = run.ChunkSizer(chunk_size, adaptive_chunks)
+            rows = run.iter_source_data(client, 'benchmark', 'synthetic_table', read_streams=read_streams)
+            fields = run.get_source_fields(client, 'benchmark', 'synthetic_table')
+            blocks = run.iter_compressed_blocks(run.iter_csv_blocks(rows, fields), compression)
+            chunks = run.iter_prefetched(run.rechunk(blocks, chunk_sizer))
+            upload_url = server.get_upload_url('streamed')
+            return run.write_streamed_data(chunks, upload_url, compression, chunk_sizer), None
+        metrics, _ = measure_stage('stream', stream, row_count, trace_memory)
+        results.append(metrics)
+
+    if trace_memory:
+        tracemalloc.stop()
+    return results
+
+def find_regressions(results: list[dict], baseline: list[dict], tolerance: float) -> list[str]:
+    """
+    Stages whose throughput dropped, or whose peak memory grew, by more than tolerance (a fraction)
+    compared with a baseline run. Memory within MEMORY_NOISE_MB of the baseline isn't counted.
+    """
+    baseline_stages = {metrics['stage']: metrics for metrics in baseline}
+    regressions = []
+    for metrics in results:
+        baseline_metrics = baseline_stages.get(metrics['stage'])
+        if not baseline_metrics:
+            continue
+        if (baseline_metrics['mb_per_second'] and metrics['mb_per_second']
+            and metrics['mb_per_second'] < baseline_metrics['mb_per_second'] * (1 - tolerance)):
+            regressions.append(
+                f'{metrics["stage"]}: {metrics["mb_per_second"]} MB/s, baseline {baseline_metrics["mb_per_second"]} MB/s')
+        baseline_peak_mb = baseline_metrics.get('peak_mb')
+        if (baseline_peak_mb is not None and metrics['peak_mb'] is not None
+            and metrics['peak_mb'] > max(baseline_peak_mb * (1 + tolerance), baseline_peak_mb + MEMORY_NOISE_MB)):
+            regressions.append(f'{metrics["stage"]}: peak {metrics["peak_mb"]} MB, baseline {baseline_peak_mb} MB')
+    return regressions
+
+def print_results(results: list[dict]):
+    print(f'{"stage":<8} {"seconds":>9} {"rows/s":>12} {"MB/s":>9} {"bytes":>12} {"peak MB":>9}')
+    for metrics in results:
+        print(f'{metrics["stage"]:<8} {metrics["seconds"]:>9} {metrics["rows_per_second"]:>12} '
+            f'{metrics["mb_per_second"]:>9} {metrics["bytes"]:>12} {str(metrics["peak_mb"]):>9}')
+    print(f'peak RSS of the process: {run.get_peak_memory_mb()} MB')
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the export pipeline against a fake BigQuery '
+        'client and a local resumable upload server')
+    parser.add_argument('--rows', dest='rows', type=int, default=100000, help='Number of synthetic rows')
+    parser.add_argument('--columns', dest='columns', type=int, default=20, help='Number of columns per row')
+    parser.add_argument('--unicode_ratio', dest='unicode_ratio', type=float, default=0.1,
+        help='Share of string values with non-ASCII characters')
+    parser.add_argument('--chunk_size_kb', dest='chunk_size_kb', type=int, default=1024,
+        help='Upload chunk size in KiB, a multiple of 256')
+    parser.add_argument('--compression', dest='compression', type=str, choices=['gzip'], required=False,
+        help='Compress the csv before uploading it')
+    parser.add_argument('--read_streams', dest='read_streams', type=int, default=1,
+        help='Number of pages of query results fetched at the same time')
+    parser.add_argument('--page_latency_ms', dest='page_latency_ms', type=int, default=0,
+        help='Simulated time for BigQuery to return each page of results')
+    parser.add_argument('--adaptive_chunks', dest='adaptive_chunks', action='store_true',
+        help='Size upload chunks from the measured throughput')
+    parser.add_argument('--upload_mb_per_second', dest='upload_mb_per_second', type=float, default=0,
+        help='Simulated upload bandwidth of the local server, unlimited by default')
+    parser.add_argument('--no_trace_memory', dest='trace_memory', action='store_false',
+        help='Skip measuring the peak python memory of each stage with tracemalloc, which slows every stage down')
+    parser.add_argument('--output', dest='output', type=str, required=False, help='Write results to a json file')
+    parser.add_argument('--baseline', dest='baseline', type=str, required=False,
+        help='Json results of an earlier run, exits with an error if a stage got slower or uses more memory')
+    parser.add_argument('--tolerance', dest='tolerance', type=float, default=0.2,
+        help='Allowed drop in MB/s and growth in peak memory from the baseline, as a fraction (default 0.2)')
+    args = parser.parse_args()
+
+    results = run_benchmark(
+        args.rows,
+        args.columns,
+        args.unicode_ratio,
+        args.chunk_size_kb * 1024,
+        args.compression,
+        args.trace_memory,
+        args.read_streams,
+        args.page_latency_ms / 1000,
+        args.adaptive_chunks,
+        args.upload_mb_per_second
+    )
+    print_results(results)
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            regressions = find_regressions(results, json.load(baseline_file), args.tolerance)
+        if regressions:
+            raise SystemExit('Regressions:\n' + '\n'.join(regressions))
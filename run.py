@@ -1,25 +1,346 @@
+from __future__ import annotations
 import argparse
+import base64
+import collections
+import contextlib
 import csv
 import datetime
+import functools
+import hashlib
 import io
+import itertools
 import json
+import mmap
 import os
+import queue
+import random
 import re
-import requests
-import google.auth
-from mig_dx_api import (
-    DX,
-    DatasetSchema,
-    Installation,
-    SchemaProperty
-)
-from mig_dx_api._dataset import DatasetOperations
-from google.cloud import bigquery
-CHUNK_SIZE = 1024 * 1024 * 16 # 16 MiB
+import resource
+import tempfile
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Iterable, Iterator
+if TYPE_CHECKING:
+    # the client libraries are imported by the stages that use them, so --help, argument errors
+    # and the stages that run before the first request don't pay for loading them
+    import httpx
+    import pyarrow
+    import requests
+    from google.cloud import bigquery
+    from mig_dx_api import DX, ClientToken, Dataset, DatasetSchema, Installation, WhoAmI
+    from mig_dx_api._dataset import DatasetOperations
+# GCS requires every chunk of a resumable upload but the last to be a multiple of 256 KiB
+UPLOAD_ALIGNMENT = 1024 * 256
+CHUNK_SIZE = UPLOAD_ALIGNMENT * 64 # 16 MiB
+MIN_CHUNK_SIZE = UPLOAD_ALIGNMENT * 4 # 1 MiB
+MAX_CHUNK_SIZE = UPLOAD_ALIGNMENT * 512 # 128 MiB
+TARGET_CHUNK_SECONDS = 5 # adaptive chunks are sized to take about this long to upload
+PREFETCH_CHUNKS = 1 # chunks encoded ahead of the upload
+ENCODE_FLUSH_SIZE = 1024 * 64 # 64 KiB
+ENCODE_BATCH_ROWS = 512 # rows passed to csv.writer at a time
+SPILL_THRESHOLD = CHUNK_SIZE * 2 # buffered data past 32 MiB is spilled to a temporary file
+COMPRESSION_LEVEL = 6
+# BigQuery types read as plain arrow columns by the arrow read engine, every other type
+# is formatted by BigQuery with TO_JSON_STRING so the csv matches the json read engine
+ARROW_NATIVE_TYPES = {'STRING', 'INT64', 'INTEGER', 'BOOL', 'BOOLEAN', 'DATE'}
+# TO_JSON_STRING gives these as json strings that never contain escapes, so dropping the quotes is enough
+ARROW_QUOTED_TYPES = {'TIMESTAMP', 'DATETIME', 'TIME', 'BYTES'}
+STATE_FILE = 'sync_state.json'
+METRICS_FILE = 'sync_metrics.json'
+CACHE_FILE = 'dx_cache.json'
+CACHE_TTL = 60 * 60 * 6 # seconds
+TOKEN_EXPIRY_MARGIN = 60 * 5 # cached tokens are dropped 5 minutes before they expire
+APP_TOKEN_LIFETIME = 60 * 60 # seconds, mig_dx_api signs app tokens that expire after an hour
+# legacy type names returned by the BigQuery API and their standard SQL names, used when casting watermarks
+STANDARD_SQL_TYPES = {'INTEGER': 'INT64', 'FLOAT': 'FLOAT64', 'BOOLEAN': 'BOOL'}
+# longest csv field a value of a fixed size type formats to, and the bytes BigQuery counts for the value
+FIXED_FIELD_SIZES = {
+    'INT64': (20, 8), 'FLOAT64': (24, 8), 'NUMERIC': (40, 16), 'BIGNUMERIC': (78, 32), 'BOOL': (5, 1),
+    'DATE': (10, 8), 'DATETIME': (26, 8), 'TIME': (15, 8), 'TIMESTAMP': (27, 8)
+}
+MAX_UPLOAD_RETRIES = 5
+RETRY_BASE_DELAY = 1 # seconds
+RETRY_MAX_DELAY = 60 # seconds
+RETRYABLE_STATUS_CODES = [408, 429, 500, 502, 503, 504]
+DX_UPLOAD_MODES = ['replace', 'create'] # upload modes mig_dx_api declares
+HTTP_POOL_SIZE = 16
+READ_PAGE_ROWS = 50000 # rows in each range of query results fetched by a parallel read
+WATCH_INTERVAL = 60 # seconds between polls of table metadata in watch mode
+WATCH_JITTER = 10 # seconds, polls and the syncs they trigger are spread over up to this much extra time
+# sync state is shared by every table in a batch, so updates to the state file are serialized
+state_lock = threading.Lock()
+confirmed_upload_modes = set() # upload modes DX has accepted in this process
+
+class UploadError(Exception):
+    """
+    Failed upload request, status_code is None when no response was received
+    """
+    def __init__(self, message: str, status_code: int = None):
+        super().__init__(message)
+        self.status_code = status_code
+
+    @property
+    def retryable(self) -> bool:
+        return self.status_code is None or self.status_code in RETRYABLE_STATUS_CODES
+
+class PartialUploadError(Exception):
+    """
+    Some shards of a sharded upload reached the dataset and others didn't, so it holds part of the export
+    """
+
+class IntegrityError(Exception):
+    """
+    Data that was uploaded or read doesn't match what was expected, offset is the first byte
+    (or row) known to be affected
+    """
+    def __init__(self, message: str, offset: int = 0):
+        super().__init__(message)
+        self.offset = offset
 
 def get_formatted_date() -> str:
     return datetime.datetime.now().strftime('%Y-%m-%dT%H:%M:%S.%f')
 
+def get_peak_memory_mb() -> float:
+    # ru_maxrss is reported in KiB on linux
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+class Metrics:
+    """
+    Time spent in each stage of a run and counters such as rows, bytes and retries, kept per table.
+    Stage times are exclusive, time spent in a nested stage isn't counted again in the stage around it.
+    Stages run on other threads, like a pipelined encoder, overlap the stages of the thread they work for.
+    Every span is written to log_path as a json line when it is set.
+    """
+    def __init__(self, log_path: str = None):
+        self.log_path = log_path
+        self.start_time = time.monotonic()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._thread_states = []
+
+    def _get_thread_state(self) -> dict:
+        # each thread keeps its own totals so rows and blocks can be counted without taking a lock
+        state = getattr(self._local, 'state', None)
+        if state is None:
+            state = {'stack': [], 'table': None, 'stages': {}, 'counters': {}, 'tables': {}}
+            self._local.state = state
+            with self._lock:
+                self._thread_states.append(state)
+        return state
+
+    def _add_stage_time(self, state: dict, name: str, seconds: float):
+        key = (state['table'], name)
+        state['stages'][key] = state['stages'].get(key, 0) + seconds
+
+    def _enter_stage(self, state: dict, name: str):
+        now = time.perf_counter()
+        stack = state['stack']
+        if stack:
+            # pause the stage around this one
+            self._add_stage_time(state, stack[-1][0], now - stack[-1][1])
+        stack.append([name, now])
+
+    def _exit_stage(self, state: dict):
+        now = time.perf_counter()
+        stack = state['stack']
+        name, start_time = stack.pop()
+        self._add_stage_time(state, name, now - start_time)
+        if stack:
+            stack[-1][1] = now
+
+    @contextlib.contextmanager
+    def span(self, name: str, **attributes):
+        """
+        Time a stage, a table attribute assigns the span and everything nested in it to that table
+        """
+        state = self._get_thread_state()
+        previous_table = state['table']
+        if 'table' in attributes:
+            state['table'] = attributes.pop('table')
+        start_time = time.perf_counter()
+        self._enter_stage(state, name)
+        try:
+            yield
+        except BaseException as error:
+            attributes['error'] = str(error)
+            raise
+        finally:
+            self._exit_stage(state)
+            seconds = time.perf_counter() - start_time
+            if name == 'table':
+                state['tables'][state['table']] = state['tables'].get(state['table'], 0) + seconds
+            self.log_event({
+                'event': 'span',
+                'name': name,
+                'table': state['table'],
+                'seconds': round(seconds, 6),
+                **attributes
+            })
+            state['table'] = previous_table
+
+    def get_table(self) -> str | None:
+        return self._get_thread_state()['table']
+
+    @contextlib.contextmanager
+    def for_table(self, table: str | None):
+        """
+        Count work done on a helper thread towards a table, without timing a span of its own
+        """
+        state = self._get_thread_state()
+        previous_table = state['table']
+        state['table'] = table
+        try:
+            yield
+        finally:
+            state['table'] = previous_table
+
+    def timed(self, name: str, iterable: Iterable) -> Iterator:
+        """
+        Count the time spent producing each item of an iterable towards a stage, without logging a span per item
+        """
+        state = self._get_thread_state()
+        stack = state['stack']
+        stages = state['stages']
+        perf_counter = time.perf_counter
+        iterator = iter(iterable)
+        # this runs once per row, so the bookkeeping of _enter_stage and _exit_stage is inlined
+        while True:
+            start_time = perf_counter()
+            if stack:
+                outer_key = (state['table'], stack[-1][0])
+                stages[outer_key] = stages.get(outer_key, 0) + start_time - stack[-1][1]
+            stack.append([name, start_time])
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                now = perf_counter()
+                stack.pop()
+                key = (state['table'], name)
+                stages[key] = stages.get(key, 0) + now - start_time
+                if stack:
+                    stack[-1][1] = now
+            yield item
+
+    def count(self, name: str, value: int = 1):
+        state = self._get_thread_state()
+        key = (state['table'], name)
+        state['counters'][key] = state['counters'].get(key, 0) + value
+
+    def log_event(self, event: dict):
+        if not self.log_path:
+            return
+        line = json.dumps({'time': get_formatted_date(), **event}, default=str)
+        with self._lock:
+            with open(self.log_path, 'a') as log_file:
+                log_file.write(line + '\n')
+
+    def get_summary(self) -> dict:
+        """
+        Totals for the whole run and for each table, with each table's throughput. Peak memory is only
+        reported for the run, ru_maxrss is the high-water mark of the process and tables can sync at the same time.
+        """
+        run_totals = {'stages': {}, 'counters': {}}
+        tables = {}
+        with self._lock:
+            thread_states = list(self._thread_states)
+        for state in thread_states:
+            for kind in ['stages', 'counters']:
+                for (table, name), value in list(state[kind].items()):
+                    totals = [run_totals]
+                    if table is not None:
+                        totals.append(tables.setdefault(table, {'stages': {}, 'counters': {}}))
+                    for total in totals:
+                        total[kind][name] = total[kind].get(name, 0) + value
+            for table, seconds in list(state['tables'].items()):
+                table_totals = tables.setdefault(table, {'stages': {}, 'counters': {}})
+                table_totals['table_seconds'] = table_totals.get('table_seconds', 0) + seconds
+
+        for table_totals in [run_totals, *tables.values()]:
+            table_totals['stages'] = {name: round(seconds, 3) for name, seconds in table_totals['stages'].items()}
+        for table_totals in tables.values():
+            # stages on helper threads overlap the table span, so its wall clock time is used when there is one
+            seconds = table_totals.pop('table_seconds', None) or sum(table_totals['stages'].values())
+            counters = table_totals['counters']
+            table_totals['seconds'] = round(seconds, 3)
+            table_totals['rows_per_second'] = round(counters.get('rows', 0) / seconds, 1) if seconds else None
+            table_totals['mb_per_second'] = (
+                round(counters.get('bytes_sent', 0) / (1024 * 1024) / seconds, 3) if seconds else None)
+        return {
+            'finished': get_formatted_date(),
+            'seconds': round(time.monotonic() - self.start_time, 3),
+            'peak_memory_mb': get_peak_memory_mb(),
+            **run_totals,
+            'tables': tables
+        }
+
+    def write_summary(self, path: str) -> dict:
+        summary = self.get_summary()
+        write_json_file(path, summary)
+        self.log_event({'event': 'summary', **summary})
+        return summary
+
+metrics = Metrics()
+
+class MetadataCache:
+    """
+    Json file of lookups that cost a round trip on every run, such as DX installations, datasets and
+    tokens and BigQuery schemas. Each entry is kept for ttl seconds, and dropped with invalidate when
+    a sync that relied on it fails.
+    """
+    def __init__(self, path: str, ttl: float = CACHE_TTL):
+        self.path = path
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        try:
+            self._entries = load_sync_state(path)
+        except json.JSONDecodeError:
+            print(f'cache file {path} is not valid json, ignoring it')
+            self._entries = {}
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry is None or entry['expires'] <= time.time():
+            return None
+        return entry['value']
+
+    def set(self, key: str, value, ttl: float = None):
+        with self._lock:
+            self._entries[key] = {'value': value, 'expires': time.time() + min(self.ttl, ttl or self.ttl)}
+            self._save()
+
+    def get_or_load(self, key: str, load_function, ttl: float = None):
+        value = self.get(key)
+        if value is None:
+            metrics.count('cache_misses')
+            value = load_function()
+            self.set(key, value, ttl)
+        else:
+            metrics.count('cache_hits')
+        return value
+
+    def invalidate(self, prefix: str):
+        """
+        Drop every entry whose key starts with prefix
+        """
+        with self._lock:
+            keys = [key for key in self._entries if key.startswith(prefix)]
+            for key in keys:
+                del self._entries[key]
+            if keys:
+                print(f'{get_formatted_date()} | dropped {len(keys)} cached entries for {prefix}')
+                self._save()
+
+    def _save(self):
+        now = time.time()
+        self._entries = {key: entry for key, entry in self._entries.items() if entry['expires'] > now}
+        # the cache holds installation tokens
+        write_json_file(self.path, self._entries, private=True)
+
 def get_target_installation(installations: list[Installation], target_installation_id: str = None) -> Installation:
     if len(installations) == 0:
         raise Exception('No valid installations found')
@@ -42,9 +363,14 @@ def get_target_installation(installations: list[Installation], target_installati
             raise Exception(f'Installation {target_installation_id} not found')
         return target_install
 
-def get_schema(client: bigquery.Client, table_name: str, dataset_id: str, project: str) -> DatasetSchema:
+def get_schema(
+    client: bigquery.Client,
+    table_name: str,
+    dataset_id: str,
+    project: str,
+    columns: list[str] = None) -> DatasetSchema:
     """
-    Get schema of source dataset from Portal BigQuery
+    Get schema of source dataset from Portal BigQuery, limited to columns when they are given
     """
     dataset_ref = client.dataset(dataset_id=dataset_id, project=project)
 
@@ -52,13 +378,19 @@ def get_schema(client: bigquery.Client, table_name: str, dataset_id: str, projec
 
     table = client.get_table(table_ref)
 
-    schema = table.schema
+    schema = get_projected_fields(table.schema, columns, table_name)
     table_constraints = table.table_constraints # might not exist
     primary_key = table_constraints.primary_key.columns if table_constraints else []
+    if columns and not set(primary_key) <= set(columns):
+        print(f'primary key {primary_key} of {table_name} is not in the exported columns, '
+            'creating the dataset without it')
+        primary_key = []
 
     print(f'{get_formatted_date()} | bigquery schema: {schema}')
     print(f'table constraints: {primary_key}')
 
+    from mig_dx_api import DatasetSchema, SchemaProperty
+
     properties = []
     for field in schema:
         # We don't care about the actual type of the field, the type is always "string"
@@ -70,102 +402,1662 @@ def get_schema(client: bigquery.Client, table_name: str, dataset_id: str, projec
         primary_key=primary_key
     )
 
-def create_dataset(dx: DX, installation: Installation, dataset_name: str, dataset_schema: DatasetSchema) -> DatasetOperations:
+def create_dataset(ctx, dataset_name: str, dataset_schema: DatasetSchema) -> DatasetOperations:
     """
-    Create MIG dataset using mig-dx-api client
+    Create MIG dataset using mig-dx-api client, through the installation context the sync already has open.
+    A nested context would restore the auth header it found when it exits, undoing a refreshed app token.
     """
     # create MIG dataset with source schema
-    with dx.installation(installation) as ctx:
-        new_dataset = ctx.datasets.create(
-            name=dataset_name,
-            description='Dataset created through Portal Script Runner',
-            schema=dataset_schema
-        )
-        print(f'{get_formatted_date()} | new dataset: {new_dataset}')
-        return new_dataset
+    new_dataset = ctx.datasets.create(
+        name=dataset_name,
+        description='Dataset created through Portal Script Runner',
+        schema=dataset_schema
+    )
+    print(f'{get_formatted_date()} | new dataset: {new_dataset}')
+    return new_dataset
 
-def get_source_data(client: bigquery.Client, dataset_id: str, table_name: str) -> list:
+def get_dx_cache_key(dx: DX, name: str) -> str:
+    return f'dx|{dx.base_url}|{dx.app_id}|{name}'
+
+def dump_schema(schema: DatasetSchema) -> dict:
+    # required is excluded from model_dump, but it is needed to load the schema again
+    return {
+        'properties': [
+            {'name': property.name, 'type': property.type, 'required': property.required}
+            for property in schema.properties
+        ],
+        'primaryKey': list(schema.primary_key)
+    }
+
+def dump_dataset(dataset: Dataset) -> dict:
+    data = dataset.model_dump(mode='json', by_alias=True)
+    data['datasetSchema'] = {**data['datasetSchema'], **dump_schema(dataset.dataset_schema)}
+    return data
+
+class KeepAliveSession:
     """
-    Get data from Portal source dataset
+    httpx client mixin that stays open when an installation context exits, so DX requests for every table
+    reuse the same connections. It is closed by close().
     """
-    sql = f"""
+    def __exit__(self, exc_type=None, exc_value=None, traceback=None):
+        pass
+
+class CachingDX:
+    """
+    DX client mixin that keeps its identity, installations and installation tokens in a MetadataCache,
+    and sends every request through one keep-alive connection pool
+    """
+    session_class = None
+
+    def __init__(self, metadata_cache: MetadataCache = None, **kwargs):
+        super().__init__(**kwargs)
+        self.metadata_cache = metadata_cache
+        self.auth_token_expires_at = time.monotonic() + APP_TOKEN_LIFETIME
+
+    def refresh_auth_token(self):
+        """
+        Sign a new app token before the current one expires, so a long running client such as
+        the ones --watch keeps can still authenticate. Installation contexts ask for their token before they
+        save the auth header, and a client never has two of them open at once, so a context never puts back
+        a token older than the one it found.
+        """
+        if time.monotonic() < self.auth_token_expires_at - TOKEN_EXPIRY_MARGIN:
+            return
+        self.auth_token = self.create_auth_token()
+        self.auth_header = f'Bearer {self.auth_token}'
+        self.auth_token_expires_at = time.monotonic() + APP_TOKEN_LIFETIME
+
+    @property
+    def session(self) -> httpx.Client:
+        if self._session is None:
+            self._session = self.session_class(**self.session_config())
+        # installation contexts swap the auth header while they are open
+        self._session.headers['Authorization'] = self.auth_header
+        return self._session
+
+    def clone(self) -> CachingDX:
+        """
+        Another client for the same app sharing the metadata cache, with connections of its own
+        """
+        dx = type(self)(self.metadata_cache, app_id=self.app_id, private_key=self._private_key)
+        dx.base_url = self.base_url
+        return dx
+
+    def load_cached(self, name: str, load_function, ttl: float = None):
+        if self.metadata_cache is None:
+            return load_function()
+        return self.metadata_cache.get_or_load(get_dx_cache_key(self, name), load_function, ttl)
+
+    def invalidate_cache(self):
+        if self.metadata_cache is not None:
+            self.metadata_cache.invalidate(get_dx_cache_key(self, ''))
+
+    def whoami(self) -> WhoAmI:
+        from mig_dx_api import WhoAmI
+
+        self.refresh_auth_token()
+        load_whoami = super().whoami
+        return WhoAmI(**self.load_cached('whoami', lambda: load_whoami().model_dump(mode='json', by_alias=True)))
+
+    def get_installations(self) -> list[Installation]:
+        from mig_dx_api import Installation
+
+        self.refresh_auth_token()
+        load_installations = super().get_installations
+        installations = self.load_cached('installations', lambda: [
+            installation.model_dump(mode='json', by_alias=True) for installation in load_installations()
+        ])
+        return [Installation(**installation) for installation in installations]
+
+    def get_client_token(self, installation_id: str) -> ClientToken:
+        from mig_dx_api import ClientToken
+
+        # an installation context asks for its token before it swaps the auth header
+        self.refresh_auth_token()
+        key = get_dx_cache_key(self, f'client_token|{installation_id}')
+        token = self.metadata_cache.get(key) if self.metadata_cache else None
+        if token is not None:
+            return ClientToken(**token)
+
+        client_token = super().get_client_token(installation_id)
+        expires_at = client_token.expires_at
+        if expires_at.tzinfo is None:
+            expires_at = expires_at.replace(tzinfo=datetime.timezone.utc)
+        ttl = (expires_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds() - TOKEN_EXPIRY_MARGIN
+        if self.metadata_cache and ttl > 0:
+            self.metadata_cache.set(key, client_token.model_dump(mode='json', by_alias=True), ttl)
+        return client_token
+
+@functools.cache
+def get_cached_dx_class() -> type[DX]:
+    """
+    Build CachedDX on first use, it subclasses the mig_dx_api and httpx clients and importing them
+    is most of the startup time of a run
+    """
+    import httpx
+    from mig_dx_api import DX
+
+    keep_alive_client = type('KeepAliveClient', (KeepAliveSession, httpx.Client), {})
+    return type('CachedDX', (CachingDX, DX), {'session_class': keep_alive_client})
+
+class WorkerDX(threading.local):
+    """
+    DX client of each worker thread, cloned from dx the first time a thread uses it. An installation context
+    swaps the auth header of its client until it exits, so syncs that run at the same time can't share a client.
+    """
+    def __init__(self, dx: DX):
+        self.dx = dx.clone()
+
+def __getattr__(name: str):
+    if name == 'CachedDX':
+        return get_cached_dx_class()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+def get_dataset_cache_key(dx: DX, installation: Installation, dataset_name: str) -> str:
+    return get_dx_cache_key(dx, f'{installation.installation_id}|dataset|{dataset_name}')
+
+def find_dataset(ctx, dataset_name: str, metadata_cache: MetadataCache = None) -> DatasetOperations:
+    """
+    Find the MIG dataset named dataset_name, raising KeyError when there isn't one.
+    Datasets found are cached, listing every dataset of the installation is only needed on a cache miss.
+    """
+    if metadata_cache is None:
+        return ctx.datasets.find(name=dataset_name)
+    key = get_dataset_cache_key(ctx.client, ctx.installation, dataset_name)
+    dataset = metadata_cache.get(key)
+    if dataset is not None:
+        from mig_dx_api import Dataset
+        from mig_dx_api._dataset import DatasetOperations
+
+        metrics.count('cache_hits')
+        return DatasetOperations(Dataset(**dataset), ctx)
+    metrics.count('cache_misses')
+    destination_dataset = ctx.datasets.find(name=dataset_name)
+    metadata_cache.set(key, dump_dataset(destination_dataset._dataset))
+    return destination_dataset
+
+def get_schema_cache_key(project: str, dataset_id: str, table_name: str, columns: list[str] = None) -> str:
+    key = f'bigquery|{project}.{dataset_id}.{table_name}|schema'
+    return f'{key}|{",".join(columns)}' if columns else key
+
+def get_cached_schema(
+    client: bigquery.Client,
+    table_name: str,
+    dataset_id: str,
+    project: str,
+    metadata_cache: MetadataCache = None,
+    columns: list[str] = None) -> DatasetSchema:
+    if metadata_cache is None:
+        return get_schema(client, table_name, dataset_id, project, columns)
+    from mig_dx_api import DatasetSchema
+
+    schema = metadata_cache.get_or_load(
+        get_schema_cache_key(project, dataset_id, table_name, columns),
+        lambda: dump_schema(get_schema(client, table_name, dataset_id, project, columns))
+    )
+    return DatasetSchema(**schema)
+
+def get_where_clause(row_filter: str = None) -> str:
+    return f'WHERE {row_filter}' if row_filter else ''
+
+def combine_row_filters(*row_filters: str | None) -> str | None:
+    """
+    Join the row filters that are set with AND, each in parentheses so OR in one filter can't leak into another
+    """
+    return ' AND '.join(f'({row_filter})' for row_filter in row_filters if row_filter) or None
+
+def get_column_list(columns: list[str] = None) -> str:
+    return ', '.join(f'`{column}`' for column in columns) if columns else '*'
+
+def get_projected_fields(
+    schema: list[bigquery.SchemaField],
+    columns: list[str] = None,
+    table_name: str = None) -> list[bigquery.SchemaField]:
+    """
+    Fields of a table schema in the order of columns, or every field when no columns are given
+    """
+    if not columns:
+        return list(schema)
+    fields = {field.name: field for field in schema}
+    missing_columns = [column for column in columns if column not in fields]
+    if missing_columns:
+        raise Exception(f'Columns {", ".join(missing_columns)} not found in {table_name}')
+    return [fields[column] for column in columns]
+
+def get_source_fields(
+    client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    columns: list[str] = None) -> list[bigquery.SchemaField]:
+    """
+    Schema of the exported columns of a source table, in the order they are exported
+    """
+    table = client.get_table(f'{dataset_id}.{table_name}')
+    return get_projected_fields(table.schema, columns, table_name)
+
+def get_source_sql(dataset_id: str, table_name: str, row_filter: str = None, columns: list[str] = None) -> str:
+    """
+    Query for the json read engine, every row of the selected columns as one json string
+    """
+    return f"""
         SELECT TO_JSON_STRING(t) json
         FROM (
-            SELECT *
+            SELECT {get_column_list(columns)}
             FROM `{dataset_id}.{table_name}`
+            {get_where_clause(row_filter)}
         ) t
     """
-    query_job = client.query(sql)
-    rows = query_job.result()
+
+def iter_in_order(fetch_page, page_count: int, max_workers: int, max_in_flight: int = None) -> Iterator:
+    """
+    Call fetch_page for every page index on a pool of threads, yielding the results in page order.
+    At most max_in_flight pages (twice max_workers by default) are fetched ahead of the consumer,
+    so memory is bounded by the page size however many pages there are.
+    """
+    max_in_flight = max_in_flight or max_workers * 2
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        pending = collections.deque()
+        next_page = 0
+        try:
+            while next_page < page_count or pending:
+                while next_page < page_count and len(pending) < max_in_flight:
+                    pending.append(executor.submit(fetch_page, next_page))
+                    next_page += 1
+                yield pending.popleft().result()
+        finally:
+            # stop fetching pages nobody will read when the consumer stops early or a page fails
+            for future in pending:
+                future.cancel()
+
+def iter_result_pages(
+    client: bigquery.Client,
+    query_job: bigquery.QueryJob,
+    rows: bigquery.table.RowIterator,
+    read_streams: int,
+    page_rows: int = READ_PAGE_ROWS,
+    to_arrow: bool = False) -> Iterator:
+    """
+    Read the results of a finished query as ranges of page_rows rows, fetched concurrently from the
+    query's destination table on read_streams threads. Pages are lists of rows, or arrow tables with to_arrow,
+    and come back in the same order as reading the results on a single stream.
+    """
+    page_count = -(-rows.total_rows // page_rows)
+    print(f'{get_formatted_date()} | reading {page_count} pages of {page_rows:,} rows on {read_streams} streams')
+
+    def fetch_page(page_index: int):
+        page = client.list_rows(
+            query_job.destination,
+            selected_fields=rows.schema,
+            start_index=page_index * page_rows,
+            max_results=page_rows
+        )
+        return page.to_arrow(create_bqstorage_client=False) if to_arrow else list(page)
+
+    for page in iter_in_order(fetch_page, page_count, read_streams):
+        metrics.count('read_pages')
+        yield page
+
+def iter_source_data(
+    client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    row_filter: str = None,
+    query_parameters: list = None,
+    read_streams: int = 1,
+    columns: list[str] = None) -> Iterator[dict]:
+    """
+    Get data from Portal source dataset one row at a time. BigQuery fetches the rows page by page,
+    on several threads at once when read_streams is more than 1.
+    """
+    from google.cloud import bigquery
+
+    sql = get_source_sql(dataset_id, table_name, row_filter, columns)
+
+    with metrics.span('query'):
+        query_job = client.query(sql, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters or []))
+        rows = query_job.result()
     print(f'{get_formatted_date()} | fetched {rows.total_rows:,} rows from {dataset_id}.{table_name}')
-    data = []
-    for row in rows:
-        row_data_string = row.values()[0]
-        data.append(json.loads(row_data_string))
+    total_rows = rows.total_rows
+    if read_streams > 1 and total_rows > READ_PAGE_ROWS:
+        rows = itertools.chain.from_iterable(iter_result_pages(client, query_job, rows, read_streams, READ_PAGE_ROWS))
+    row_count = 0
+    try:
+        for row in rows:
+            row_data_string = row.values()[0]
+            row_count += 1
+            yield json.loads(row_data_string)
+    finally:
+        metrics.count('rows', row_count)
+    check_row_count(row_count, total_rows, dataset_id, table_name)
+
+def check_row_count(row_count: int, total_rows: int | None, dataset_id: str, table_name: str):
+    """
+    The rows read have to add up to the row count of the query job, before the last chunk is uploaded
+    """
+    if total_rows is not None and row_count != total_rows:
+        raise IntegrityError(
+            f'Read {row_count:,} rows from {dataset_id}.{table_name} but the query returned {total_rows:,}',
+            min(row_count, total_rows))
+
+def iter_counted_batches(batches: Iterable, total_rows: int | None, dataset_id: str, table_name: str) -> Iterator:
+    """
+    Pass arrow record batches through, checking the number of rows once they have all been read
+    """
+    row_count = 0
+    for batch in batches:
+        row_count += batch.num_rows
+        yield batch
+    check_row_count(row_count, total_rows, dataset_id, table_name)
+
+def get_source_data(client: bigquery.Client, dataset_id: str, table_name: str, read_streams: int = 1) -> list:
+    """
+    Get data from Portal source dataset
+    """
+    data = list(metrics.timed(
+        'fetch', iter_source_data(client, dataset_id, table_name, read_streams=read_streams)))
     print(f'{get_formatted_date()} | finished collecting data')
     return data
 
-def create_data_buffer(source_data: list) -> io.StringIO:
-    fieldnames = source_data[0].keys()
-    buffer = io.StringIO()
-    writer = csv.DictWriter(buffer, fieldnames=fieldnames)
-    writer.writeheader()
-    writer.writerows(source_data)
+def get_schema_fingerprint(schema: list[bigquery.SchemaField]) -> str:
+    """
+    Hash of the column names, types and modes of a table, including nested fields
+    """
+    description = [
+        [field.name, field.field_type, field.mode, get_schema_fingerprint(field.fields)]
+        for field in schema
+    ]
+    return hashlib.sha256(json.dumps(description).encode('utf-8')).hexdigest()
+
+def get_high_watermark(client: bigquery.Client, dataset_id: str, table_name: str, watermark_column: str) -> str | None:
+    """
+    Current maximum of the watermark column, as a string that casts back to the column type without loss
+    """
+    sql = f"""
+        SELECT CAST(MAX(`{watermark_column}`) AS STRING) watermark
+        FROM `{dataset_id}.{table_name}`
+    """
+    rows = client.query(sql).result()
+    return list(rows)[0].values()[0]
+
+def get_watermark_filter(
+    watermark_field: bigquery.SchemaField,
+    low_watermark: str | None,
+    high_watermark: str) -> tuple[str, list]:
+    """
+    Filter for rows after low_watermark up to and including high_watermark. Without a low watermark
+    every row is selected, including rows where the watermark is NULL.
+    """
+    column = f'`{watermark_field.name}`'
+    from google.cloud import bigquery
+
+    column_type = STANDARD_SQL_TYPES.get(watermark_field.field_type, watermark_field.field_type)
+    query_parameters = [bigquery.ScalarQueryParameter('high_watermark', 'STRING', high_watermark)]
+    if low_watermark is None:
+        row_filter = f'({column} <= CAST(@high_watermark AS {column_type}) OR {column} IS NULL)'
+    else:
+        row_filter = (f'{column} > CAST(@low_watermark AS {column_type}) '
+            f'AND {column} <= CAST(@high_watermark AS {column_type})')
+        query_parameters.append(bigquery.ScalarQueryParameter('low_watermark', 'STRING', low_watermark))
+    return row_filter, query_parameters
+
+def plan_incremental_sync(
+    client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    watermark_column: str,
+    incremental_mode: str,
+    previous_state: dict | None,
+    columns: list[str] = None,
+    where: str = None) -> dict | None:
+    """
+    Work out which rows a watermark sync needs to export. Falls back to a full replace when there is
+    no previous watermark or the exported schema or row filter has changed since it was saved.
+    Returns None when there are no new rows, otherwise the row filter, query parameters, upload mode
+    and the table state to save once the upload succeeds.
+    """
+    table = client.get_table(f'{dataset_id}.{table_name}')
+    watermark_field = next((field for field in table.schema if field.name == watermark_column), None)
+    if watermark_field is None:
+        raise Exception(f'Watermark column {watermark_column} not found in {dataset_id}.{table_name}')
+
+    schema_fingerprint = get_schema_fingerprint(get_projected_fields(table.schema, columns, table_name))
+    high_watermark = get_high_watermark(client, dataset_id, table_name, watermark_column)
+    low_watermark = None
+    upload_mode = 'replace'
+    if previous_state is None:
+        print(f'no previous watermark for {dataset_id}.{table_name}, running a full sync')
+    elif (previous_state.get('watermark_column') != watermark_column
+        or previous_state.get('schema_fingerprint') != schema_fingerprint
+        or previous_state.get('where') != where):
+        print(f'schema, filter or watermark column of {dataset_id}.{table_name} changed since the last sync, '
+            'running a full sync')
+    elif previous_state['watermark'] == high_watermark:
+        return None
+    else:
+        low_watermark = previous_state['watermark']
+        upload_mode = incremental_mode
+        table_constraints = table.table_constraints # might not exist
+        if upload_mode == 'upsert' and not (table_constraints and table_constraints.primary_key):
+            raise Exception(f'Upsert sync requires a primary key on {dataset_id}.{table_name}')
+        if upload_mode == 'upsert' and columns and not set(table_constraints.primary_key.columns) <= set(columns):
+            raise Exception(
+                f'Upsert sync requires the primary key of {dataset_id}.{table_name} in the exported columns')
+        print(f'syncing rows of {dataset_id}.{table_name} with {watermark_column} after {low_watermark}')
+
+    row_filter, query_parameters = get_watermark_filter(watermark_field, low_watermark, high_watermark)
+    state = {
+        'watermark_column': watermark_column,
+        'watermark': high_watermark,
+        'schema_fingerprint': schema_fingerprint,
+        'updated': get_formatted_date()
+    }
+    if where:
+        state['where'] = where
+    return {
+        'row_filter': row_filter,
+        'query_parameters': query_parameters,
+        'upload_mode': upload_mode,
+        'state': state
+    }
+
+def get_table_checksum(
+    client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    columns: list[str] = None,
+    where: str = None) -> str:
+    """
+    Order independent checksum of every exported row in a table, this scans the selected columns
+    """
+    sql = f"""
+        SELECT FORMAT('%d:%d', COUNT(*), IFNULL(BIT_XOR(FARM_FINGERPRINT(TO_JSON_STRING(t))), 0)) checksum
+        FROM (
+            SELECT {get_column_list(columns)}
+            FROM `{dataset_id}.{table_name}`
+            {get_where_clause(where)}
+        ) t
+    """
+    rows = client.query(sql).result()
+    return list(rows)[0].values()[0]
+
+def get_table_fingerprint(
+    client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    verify_checksum: bool = False,
+    columns: list[str] = None,
+    where: str = None) -> dict | None:
+    """
+    Fingerprint of a source table from its metadata, optionally confirmed with a checksum of its contents.
+    Returns None when the metadata alone can't show whether the data changed (views, or tables with
+    rows in the streaming buffer) and no checksum was asked for.
+    """
+    table = client.get_table(f'{dataset_id}.{table_name}')
+    fingerprint = {
+        'modified': table.modified.isoformat() if table.modified else None,
+        'num_rows': table.num_rows,
+        'num_bytes': table.num_bytes,
+        'schema_fingerprint': get_schema_fingerprint(get_projected_fields(table.schema, columns, table_name))
+    }
+    if where:
+        fingerprint['where'] = where
+    if verify_checksum:
+        fingerprint['checksum'] = get_table_checksum(client, dataset_id, table_name, columns, where)
+    elif table.table_type != 'TABLE' or table.streaming_buffer is not None:
+        return None
+    return fingerprint
+
+def estimate_csv_size(fields: list[bigquery.SchemaField], num_rows: int, bytes_processed: int) -> int:
+    """
+    Estimate the size of a csv export from its column types. Fixed size values are counted at their longest
+    formatted length. Strings, bytes and nested values get the scanned bytes left after the fixed size columns,
+    BigQuery counts those close to their formatted length. Every row of the table is counted, so a filter
+    that leaves rows out makes the csv smaller than the estimate.
+    """
+    num_rows = num_rows or 0
+    fixed_sizes = [
+        FIXED_FIELD_SIZES[STANDARD_SQL_TYPES.get(field.field_type, field.field_type)] for field in fields
+        if field.mode != 'REPEATED' and STANDARD_SQL_TYPES.get(field.field_type, field.field_type) in FIXED_FIELD_SIZES
+    ]
+    variable_bytes = max(bytes_processed - num_rows * sum(scanned for _, scanned in fixed_sizes), 0)
+    # a delimiter after every field but the last and a line break after each row
+    row_size = sum(width for width, _ in fixed_sizes) + len(fields) + 1
+    header_size = sum(len(field.name) for field in fields) + len(fields) + 1
+    return header_size + num_rows * row_size + variable_bytes
+
+def estimate_table_export(
+    client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    columns: list[str] = None,
+    where: str = None) -> dict:
+    """
+    Dry run the export query of a table. BigQuery validates the query and reports the bytes it would
+    scan without running it, the size of the csv is estimated from those bytes and the column types.
+    """
+    from google.cloud import bigquery
+
+    table = client.get_table(f'{dataset_id}.{table_name}')
+    fields = get_projected_fields(table.schema, columns, table_name)
+    sql = get_source_sql(dataset_id, table_name, where, columns)
+    with metrics.span('dry_run'):
+        query_job = client.query(sql, job_config=bigquery.QueryJobConfig(dry_run=True, use_query_cache=False))
+    estimate = {
+        'table_name': table_name,
+        'columns': len(fields),
+        'table_rows': table.num_rows,
+        'bytes_processed': query_job.total_bytes_processed,
+        'estimated_upload_bytes': estimate_csv_size(fields, table.num_rows, query_job.total_bytes_processed)
+    }
+    metrics.count('bytes_processed', query_job.total_bytes_processed)
+    print(f'{get_formatted_date()} | dry run of {dataset_id}.{table_name}: '
+        f'{len(fields)} columns of {table.num_rows:,} rows, scans {query_job.total_bytes_processed:,} bytes, '
+        f'csv of about {estimate["estimated_upload_bytes"]:,} bytes before compression')
+    return estimate
+
+def write_json_file(path: str, data: dict, private: bool = False):
+    """
+    Write json to path, a private file can only be read by its owner
+    """
+    # write to a temporary file first so an interrupted run never leaves a partial file
+    temp_path = f'{path}.tmp'
+    mode = 0o600 if private else 0o666
+    with open(os.open(temp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode), 'w') as json_file:
+        json.dump(data, json_file)
+    os.replace(temp_path, path)
+
+def get_state_key(installation_id: int, dataset_id: str, table_name: str) -> str:
+    return f'{installation_id}.{dataset_id}.{table_name}'
+
+def load_sync_state(state_file: str) -> dict:
+    try:
+        with open(state_file) as json_file:
+            return json.load(json_file)
+    except FileNotFoundError:
+        return {}
+
+def save_table_state(state_file: str, state_key: str, table_state: dict, replace: bool = False):
+    """
+    Merge table_state into the saved state of a table. With replace, as after a full sync,
+    table_state takes the place of the saved state so an old watermark isn't picked up again.
+    """
+    with state_lock:
+        sync_state = load_sync_state(state_file)
+        sync_state[state_key] = {**({} if replace else sync_state.get(state_key, {})), **table_state}
+        write_json_file(state_file, sync_state)
+
+def parse_hash_header(header: str) -> dict:
+    """
+    Hashes of an x-goog-hash header such as 'crc32c=n03x6A==,md5=Ojk9c3dhfxgoKVVHYwFbHQ=='
+    """
+    hashes = {}
+    for part in header.split(','):
+        name, _, value = part.strip().partition('=')
+        if value:
+            hashes[name] = value
+    return hashes
+
+class UploadDigest:
+    """
+    Rolling CRC32C and MD5 of the bytes of an upload, updated as the data is encoded or streamed
+    so the upload can be checked without reading the data again. CRC32C needs google-crc32c,
+    which is installed with google-cloud-bigquery.
+    """
+    def __init__(self):
+        try:
+            import google_crc32c
+            self._crc32c = google_crc32c.Checksum()
+        except ImportError:
+            self._crc32c = None
+        self._md5 = hashlib.md5()
+        self.size = 0
+
+    def update(self, data: bytes):
+        if self._crc32c is not None:
+            self._crc32c.update(data)
+        self._md5.update(data)
+        self.size += len(data)
+
+    def get_hashes(self) -> dict:
+        hashes = {}
+        if self._crc32c is not None:
+            hashes['crc32c'] = base64.b64encode(self._crc32c.digest()).decode('ascii')
+        hashes['md5'] = base64.b64encode(self._md5.digest()).decode('ascii')
+        return hashes
+
+    def get_hash_header(self) -> str:
+        return ','.join(f'{name}={value}' for name, value in self.get_hashes().items())
+
+    def verify(self, response: requests.Response):
+        """
+        Compare the size and hashes the bucket reports for the completed object with the bytes that were sent
+        """
+        stored_size = response.headers.get('x-goog-stored-content-length')
+        if stored_size is not None and int(stored_size) != self.size:
+            raise IntegrityError(
+                f'Upload failed: bucket stored {stored_size} bytes but {self.size} were sent',
+                min(int(stored_size), self.size))
+        stored_hashes = parse_hash_header(response.headers.get('x-goog-hash', ''))
+        verified = []
+        for name, value in self.get_hashes().items():
+            if name not in stored_hashes:
+                continue
+            if stored_hashes[name] != value:
+                raise IntegrityError(
+                    f'Upload failed: {name} of the stored object is {stored_hashes[name]} but bytes 0-{self.size - 1} '
+                    f'sent have {value}')
+            verified.append(name)
+        if verified:
+            print(f'{get_formatted_date()} | verified {" and ".join(verified)} of {self.size} bytes uploaded')
+            metrics.count('bytes_verified', self.size)
+
+class SpillingBuffer:
+    """
+    Binary buffer that keeps data in memory up to max_memory_size bytes and spills to a temporary file past that.
+    size is the exact number of bytes written, and chunks are served as memory views rather than copies.
+    digest hashes the data as it is written.
+    """
+    def __init__(self, max_memory_size: int = SPILL_THRESHOLD, spill_path: str = None):
+        self.max_memory_size = max_memory_size
+        # spill to a named file that outlives the buffer instead of an anonymous temporary file
+        self.spill_path = spill_path
+        self.size = 0
+        self.digest = UploadDigest()
+        self._memory = bytearray()
+        self._file = None
+        self._mmap = None
+
+    @classmethod
+    def from_file(cls, path: str) -> 'SpillingBuffer':
+        """
+        Open data spilled to disk by an earlier buffer
+        """
+        buffer = cls(spill_path=path)
+        buffer._memory = None
+        buffer._file = open(path, 'r+b')
+        buffer.size = os.path.getsize(path)
+        buffer.digest = None
+        return buffer
+
+    @property
+    def spilled(self) -> bool:
+        return self._file is not None
+
+    def write(self, data: bytes) -> int:
+        if self._file is None and self.size + len(data) > self.max_memory_size:
+            print(f'{get_formatted_date()} | buffer is larger than {self.max_memory_size} bytes, spilling to disk')
+            self._file = open(self.spill_path, 'w+b') if self.spill_path else tempfile.TemporaryFile()
+            self._file.write(self._memory)
+            self._memory = None
+        if self._file is None:
+            self._memory += data
+        else:
+            self._file.write(data)
+        self.size += len(data)
+        self.digest.update(data)
+        return len(data)
+
+    def get_digest(self) -> UploadDigest:
+        """
+        Digest of the data in the buffer, data opened from a file is hashed the first time it is needed
+        """
+        if self.digest is None:
+            self.digest = UploadDigest()
+            for chunk in self.iter_chunks(CHUNK_SIZE):
+                self.digest.update(bytes(chunk))
+        return self.digest
+
+    def tell(self) -> int:
+        return self.size
+
+    def getbuffer(self) -> memoryview:
+        """
+        View over the whole buffer, spilled data is memory mapped instead of read back into memory
+        """
+        if self._file is None:
+            return memoryview(self._memory)
+        if self._mmap is None:
+            self._file.flush()
+            self._mmap = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        return memoryview(self._mmap)
+
+    def getvalue(self) -> bytes:
+        return bytes(self.getbuffer())
+
+    def iter_chunks(self, chunk_size: int) -> Iterator[memoryview]:
+        view = self.getbuffer()
+        for start_byte in range(0, self.size, chunk_size):
+            yield view[start_byte:start_byte + chunk_size]
+
+    def close(self):
+        # views handed out may still be alive, so the memory and mapping are released when they are collected
+        self._memory = None
+        self._mmap = None
+        if self._file is not None:
+            self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def create_data_buffer(
+    source_data: Iterable[dict],
+    max_memory_size: int = SPILL_THRESHOLD,
+    spill_path: str = None,
+    compression: str = None,
+    fields: list[bigquery.SchemaField] = None) -> SpillingBuffer:
+    buffer = SpillingBuffer(max_memory_size, spill_path)
+    for block in iter_compressed_blocks(iter_csv_blocks(source_data, fields), compression):
+        buffer.write(block)
+    return buffer
+
+def decompress_data_buffer(
+    data_buffer: SpillingBuffer,
+    compression: str,
+    max_memory_size: int = SPILL_THRESHOLD,
+    spill_path: str = None) -> SpillingBuffer:
+    """
+    Decompress a buffer into a new one and close the compressed buffer. With a spill_path the decompressed data
+    takes the place of the compressed file on disk, so a checkpointed upload resumes from it.
+    """
+    decompressed_path = f'{spill_path}.decompressed' if spill_path else None
+    with data_buffer:
+        buffer = SpillingBuffer(0 if spill_path else max_memory_size, decompressed_path)
+        for block in iter_decompressed_blocks(data_buffer.iter_chunks(CHUNK_SIZE), compression):
+            buffer.write(block)
+    if spill_path is None:
+        return buffer
+    digest = buffer.digest
+    buffer.close()
+    os.replace(decompressed_path, spill_path)
+    buffer = SpillingBuffer.from_file(spill_path)
+    buffer.digest = digest
     return buffer
 
-def get_upload_url(dataset: DatasetOperations, is_resumable: bool = False):
-    if is_resumable:
-        return dataset.get_upload_url(mode='replace', upload_type='resumable')
+def create_shard_buffers(
+    source_data: Iterable[dict],
+    shard_count: int,
+    max_memory_size: int = SPILL_THRESHOLD,
+    compression: str = None,
+    fields: list[bigquery.SchemaField] = None) -> list[SpillingBuffer]:
+    """
+    Encode rows into shard_count independent csv files, each with its own header, on a thread per shard.
+    Rows are dealt to the shards ENCODE_BATCH_ROWS at a time so the shards come out about the same size,
+    and max_memory_size is split between them. Shards that got no rows are left out.
+    """
+    shard_queues = [queue.Queue(maxsize=2) for _ in range(shard_count)]
+    table = metrics.get_table()
+
+    def iter_shard_rows(shard_queue: queue.Queue) -> Iterator[dict]:
+        while (batch := shard_queue.get()) is not None:
+            yield from batch
+
+    def encode_shard(shard_queue: queue.Queue) -> SpillingBuffer:
+        with metrics.for_table(table):
+            return create_data_buffer(
+                iter_shard_rows(shard_queue), max_memory_size // shard_count, compression=compression, fields=fields)
+
+    with ThreadPoolExecutor(max_workers=shard_count) as executor:
+        futures = [executor.submit(encode_shard, shard_queue) for shard_queue in shard_queues]
+
+        def put(shard_index: int, batch: list | None) -> bool:
+            # an encoder that failed stops taking batches, so stop waiting for it rather than block forever
+            while not futures[shard_index].done():
+                try:
+                    shard_queues[shard_index].put(batch, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            try:
+                rows = iter(source_data)
+                for shard_index in itertools.cycle(range(shard_count)):
+                    batch = list(itertools.islice(rows, ENCODE_BATCH_ROWS))
+                    if not batch:
+                        break
+                    if not put(shard_index, batch):
+                        futures[shard_index].result()
+            finally:
+                # the end of the rows also stops the encoders when reading fails
+                for shard_index in range(shard_count):
+                    put(shard_index, None)
+            buffers = [future.result() for future in futures]
+        except BaseException:
+            for future in futures:
+                if future.exception() is None:
+                    future.result().close()
+            raise
 
-    return dataset.get_upload_url(mode='replace')
+    for buffer in buffers:
+        if buffer.size == 0:
+            buffer.close()
+    return [buffer for buffer in buffers if buffer.size > 0]
 
-def write_data_to_signed_url(source_data: list, destination_dataset: DatasetOperations, upload_url: str):
-    # Upload the data for the dataset in MIG to presigned url
-    response = destination_dataset.upload_data_to_url(upload_url['url'], source_data)
-    # Log results
+class ChunkSizer:
+    """
+    Size of the next upload chunk, always a multiple of UPLOAD_ALIGNMENT. When adaptive the size follows
+    the measured upload throughput, so a fast link sends fewer, larger chunks and a slow or flaky one
+    (retries and backoff make a chunk slow too) sends smaller chunks that cost less to send again.
+    """
+    def __init__(
+        self,
+        size: int = CHUNK_SIZE,
+        adaptive: bool = False,
+        min_size: int = MIN_CHUNK_SIZE,
+        max_size: int = MAX_CHUNK_SIZE,
+        target_seconds: float = TARGET_CHUNK_SECONDS):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.adaptive = adaptive
+        self.target_seconds = target_seconds
+        self.size = self.align(size)
+
+    def align(self, size: float) -> int:
+        size = int(size) // UPLOAD_ALIGNMENT * UPLOAD_ALIGNMENT
+        return max(self.min_size, min(self.max_size, size))
+
+    def record(self, chunk_size: int, seconds: float):
+        """
+        Adjust the size after a chunk of chunk_size bytes took seconds to upload, by at most a factor of 2
+        """
+        # a short final chunk says little about the link
+        if not self.adaptive or chunk_size < self.size // 2:
+            return
+        ideal_size = chunk_size / max(seconds, 0.001) * self.target_seconds
+        new_size = self.align(min(max(ideal_size, self.size / 2), self.size * 2))
+        if new_size != self.size:
+            print(f'{get_formatted_date()} | chunk of {chunk_size} bytes took {seconds:.1f} seconds, '
+                f'changing chunk size to {new_size} bytes')
+            self.size = new_size
+
+def rechunk(blocks: Iterable[bytes], chunk_size: int | ChunkSizer) -> Iterator[bytes]:
+    """
+    Regroup encoded blocks of any size into chunks of exactly chunk_size bytes (the last chunk may be smaller),
+    with a ChunkSizer each chunk takes its current size
+    """
+    pending = bytearray()
+    for block in blocks:
+        pending += block
+        size = chunk_size if isinstance(chunk_size, int) else chunk_size.size
+        while len(pending) >= size:
+            yield bytes(pending[:size])
+            del pending[:size]
+            size = chunk_size if isinstance(chunk_size, int) else chunk_size.size
+    if pending:
+        yield bytes(pending)
+
+def format_nested_value(value):
+    """
+    Format record and repeated values as compact json, the same way in both read engines.
+    Other values are left for csv.writer, which writes NULL as an empty field and everything else with str().
+    """
+    if isinstance(value, (dict, list)):
+        return json.dumps(value, ensure_ascii=False, separators=(',', ':'))
+    return value
+
+def get_field_formatter(field: bigquery.SchemaField):
+    """
+    Formatter for the values of a column, or None when csv.writer formats them on its own. TO_JSON_STRING
+    gives strings, timestamps, dates, bytes and geographies as json strings and numbers and booleans
+    as json scalars, so only records, arrays and JSON columns need formatting.
+    """
+    if field.mode == 'REPEATED' or field.field_type in ('RECORD', 'STRUCT', 'JSON'):
+        return format_nested_value
+    return None
+
+class RowEncoder:
+    """
+    CSV encoder built once per table from its BigQuery schema. The header and column order come from the schema
+    rather than from the keys of each row, so rows where TO_JSON_STRING omits or reorders keys still line up,
+    and values are read with one C level map over the columns instead of csv.DictWriter's checks on every row.
+    """
+    def __init__(self, columns: list[str], formatters: dict[int, object] = None):
+        self.columns = columns
+        self.formatters = list((formatters or {}).items())
+
+    @classmethod
+    def from_schema(cls, fields: list[bigquery.SchemaField]) -> 'RowEncoder':
+        formatters = {index: get_field_formatter(field) for index, field in enumerate(fields)}
+        return cls(
+            [field.name for field in fields],
+            {index: formatter for index, formatter in formatters.items() if formatter is not None}
+        )
+
+    @classmethod
+    def from_row(cls, row: dict) -> 'RowEncoder':
+        """
+        Encoder for rows read without a schema, every column may hold a nested value
+        """
+        return cls(list(row.keys()), {index: format_nested_value for index in range(len(row))})
+
+    def get_values(self, row: dict) -> list:
+        values = list(map(row.get, self.columns))
+        for index, formatter in self.formatters:
+            values[index] = formatter(values[index])
+        return values
+
+    def iter_blocks(self, rows: Iterable[dict]) -> Iterator[bytes]:
+        """
+        Encode rows as CSV, yielding UTF-8 encoded blocks of roughly ENCODE_FLUSH_SIZE bytes.
+        Nothing is written, not even the header, when there are no rows.
+        """
+        rows = iter(rows)
+        batch = list(itertools.islice(rows, ENCODE_BATCH_ROWS))
+        if not batch:
+            return
+        text_buffer = io.StringIO()
+        writer = csv.writer(text_buffer)
+        writer.writerow(self.columns)
+        columns = self.columns
+        get_values = self.get_values
+        while batch:
+            if self.formatters:
+                writer.writerows(map(get_values, batch))
+            else:
+                writer.writerows([map(row.get, columns) for row in batch])
+            # move encoded text out of the buffer in batches rather than once per row
+            if text_buffer.tell() >= ENCODE_FLUSH_SIZE:
+                yield text_buffer.getvalue().encode('utf-8')
+                text_buffer.seek(0)
+                text_buffer.truncate()
+            batch = list(itertools.islice(rows, ENCODE_BATCH_ROWS))
+        if text_buffer.tell():
+            yield text_buffer.getvalue().encode('utf-8')
+
+def iter_csv_blocks(rows: Iterable[dict], fields: list[bigquery.SchemaField] = None) -> Iterator[bytes]:
+    """
+    Encode rows as CSV, yielding UTF-8 encoded blocks of roughly ENCODE_FLUSH_SIZE bytes. Without the schema
+    of the source table the columns are taken from the first row.
+    """
+    if fields is not None:
+        yield from RowEncoder.from_schema(fields).iter_blocks(rows)
+        return
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is not None:
+        yield from RowEncoder.from_row(first_row).iter_blocks(itertools.chain([first_row], rows))
+
+def iter_compressed_blocks(blocks: Iterable[bytes], compression: str = None) -> Iterator[bytes]:
+    """
+    Compress encoded blocks on the fly, without compression the blocks pass through unchanged
+    """
+    if compression is None:
+        yield from blocks
+        return
+    if compression != 'gzip':
+        raise Exception(f'Unsupported compression: {compression}')
+    # wbits of 31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(COMPRESSION_LEVEL, zlib.DEFLATED, 31)
+    for block in blocks:
+        compressed_block = compressor.compress(block)
+        if compressed_block:
+            yield compressed_block
+    yield compressor.flush()
+
+def iter_decompressed_blocks(blocks: Iterable[bytes], compression: str = None) -> Iterator[bytes]:
+    """
+    Undo iter_compressed_blocks on the fly, each block is decompressed into pieces of at most CHUNK_SIZE bytes
+    """
+    if compression is None:
+        yield from blocks
+        return
+    if compression != 'gzip':
+        raise Exception(f'Unsupported compression: {compression}')
+    decompressor = zlib.decompressobj(31)
+    for block in blocks:
+        while block:
+            decompressed_block = decompressor.decompress(block, CHUNK_SIZE)
+            block = decompressor.unconsumed_tail
+            if decompressed_block:
+                yield decompressed_block
+    yield decompressor.flush()
+
+def iter_prefetched(iterable: Iterable, max_ahead: int = PREFETCH_CHUNKS) -> Iterator:
+    """
+    Produce the items of an iterable on a background thread, at most max_ahead items ahead of the consumer,
+    so the next chunk is fetched and encoded while the current one is being uploaded.
+    Errors raised by the producer are raised again in the consumer.
+    """
+    results = queue.Queue(maxsize=max_ahead)
+    stopped = threading.Event()
+    table = metrics.get_table()
+
+    def put(result: tuple) -> bool:
+        # give up once the consumer has stopped rather than block on a full queue forever
+        while not stopped.is_set():
+            try:
+                results.put(result, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        with metrics.for_table(table):
+            try:
+                for item in iterable:
+                    if not put(('item', item)):
+                        return
+                put(('done', None))
+            except BaseException as error:
+                put(('error', error))
+
+    threading.Thread(target=produce, daemon=True).start()
+    try:
+        while True:
+            kind, value = results.get()
+            if kind == 'done':
+                return
+            if kind == 'error':
+                raise value
+            yield value
+    finally:
+        stopped.set()
+
+def get_arrow_source_sql(
+    client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    row_filter: str = None,
+    columns: list[str] = None) -> tuple[str, dict[str, bigquery.SchemaField]]:
+    """
+    Build the query for the arrow read engine. Columns that arrow can't format the same way as
+    the json read engine are wrapped in TO_JSON_STRING, their fields are returned alongside the query.
+    """
+    selected_columns = []
+    json_columns = {}
+    for field in get_source_fields(client, dataset_id, table_name, columns):
+        if field.field_type in ARROW_NATIVE_TYPES and field.mode != 'REPEATED':
+            selected_columns.append(f'`{field.name}`')
+        else:
+            selected_columns.append(f'TO_JSON_STRING(`{field.name}`) `{field.name}`')
+            json_columns[field.name] = field
+    column_list = ',\n            '.join(selected_columns)
+    sql = f"""
+        SELECT
+            {column_list}
+        FROM `{dataset_id}.{table_name}`
+        {get_where_clause(row_filter)}
+    """
+    return sql, json_columns
+
+def get_bqstorage_client(client: bigquery.Client):
+    """
+    Create a BigQuery Storage API client if the library is installed, otherwise results are read over REST
+    """
+    try:
+        from google.cloud import bigquery_storage
+    except ImportError:
+        print('google-cloud-bigquery-storage is not installed, reading arrow batches over REST')
+        return None
+    return bigquery_storage.BigQueryReadClient(credentials=client._credentials)
+
+def iter_source_batches(
+    client: bigquery.Client,
+    dataset_id: str,
+    table_name: str,
+    row_filter: str = None,
+    query_parameters: list = None,
+    read_streams: int = 1,
+    columns: list[str] = None) -> tuple[Iterator, dict[str, bigquery.SchemaField]]:
+    """
+    Get data from Portal source dataset as arrow record batches. The Storage API reads several streams
+    on its own, over REST the results are read as pages on read_streams threads.
+    """
+    from google.cloud import bigquery
+
+    import_pyarrow()
+    sql, json_columns = get_arrow_source_sql(client, dataset_id, table_name, row_filter, columns)
+    with metrics.span('query'):
+        query_job = client.query(sql, job_config=bigquery.QueryJobConfig(query_parameters=query_parameters or []))
+        rows = query_job.result()
+    print(f'{get_formatted_date()} | fetched {rows.total_rows:,} rows from {dataset_id}.{table_name}')
+    bqstorage_client = get_bqstorage_client(client)
+    if bqstorage_client is None and read_streams > 1 and rows.total_rows > READ_PAGE_ROWS:
+        pages = iter_result_pages(client, query_job, rows, read_streams, READ_PAGE_ROWS, to_arrow=True)
+        batches = (batch for page in pages for batch in page.to_batches())
+    else:
+        # the Storage API queues at most one batch per stream ahead of the encoder
+        batches = rows.to_arrow_iterable(bqstorage_client=bqstorage_client)
+    return iter_counted_batches(batches, rows.total_rows, dataset_id, table_name), json_columns
+
+def import_pyarrow():
+    """
+    pyarrow is only needed for the arrow read engine
+    """
+    try:
+        import pyarrow
+        import pyarrow.compute
+    except ImportError:
+        raise Exception('pyarrow must be installed to use the arrow read engine')
+    return pyarrow, pyarrow.compute
+
+def format_json_value(json_string: str | None) -> str:
+    """
+    Format a TO_JSON_STRING value the same way the json read engine formats the json.loads result
+    """
+    if json_string is None:
+        return ''
+    value = format_nested_value(json.loads(json_string))
+    return '' if value is None else str(value)
+
+def encode_arrow_column(column, json_field: bigquery.SchemaField = None):
+    """
+    Convert an arrow column to an array of csv fields using vectorized compute functions. Only floats,
+    numerics, geographies, records, arrays and JSON columns are decoded with json.loads one value at a time,
+    so they come out exactly as the json read engine writes them.
+    """
+    pyarrow, pc = import_pyarrow()
+    if json_field is not None and json_field.field_type in ARROW_QUOTED_TYPES and json_field.mode != 'REPEATED':
+        column = pc.if_else(pc.equal(column, 'null'), '', pc.utf8_slice_codeunits(column, 1, -1))
+    elif json_field is not None:
+        column = pyarrow.array([format_json_value(value) for value in column.to_pylist()], pyarrow.string())
+    elif pyarrow.types.is_boolean(column.type):
+        column = pc.if_else(column, 'True', 'False')
+    column = column.cast(pyarrow.string()).fill_null('')
+    # same rule as csv.QUOTE_MINIMAL, quote fields containing the delimiter, quote character or line breaks
+    needs_quotes = pc.match_substring_regex(column, '[,"\r\n]')
+    quoted = pc.binary_join_element_wise('"', pc.replace_substring(column, '"', '""'), '"', '')
+    return pc.if_else(needs_quotes, quoted, column)
+
+def encode_arrow_batch(batch, json_columns: dict[str, bigquery.SchemaField]) -> bytes:
+    """
+    Encode an arrow record batch as CSV rows without building a python object per row
+    """
+    if batch.num_rows == 0:
+        return b''
+    pyarrow, pc = import_pyarrow()
+    fields = [
+        encode_arrow_column(batch.column(index), json_columns.get(name))
+        for index, name in enumerate(batch.schema.names)
+    ]
+    lines = pc.binary_join_element_wise(*fields, ',')
+    if len(fields) == 1:
+        # csv quotes an empty field when it is the only field in the row
+        lines = pc.if_else(pc.equal(lines, ''), '""', lines)
+    lines = pc.binary_join_element_wise(lines, '', '\r\n')
+    offsets = pyarrow.array([0, len(lines)], pyarrow.int32())
+    joined = pc.binary_join(pyarrow.ListArray.from_arrays(offsets, lines.cast(pyarrow.binary())), b'')
+    return joined[0].as_buffer().to_pybytes()
+
+def iter_arrow_csv_blocks(batches: Iterable, json_columns: dict[str, bigquery.SchemaField]) -> Iterator[bytes]:
+    """
+    Encode arrow record batches as CSV, yielding one UTF-8 encoded block per batch
+    """
+    header_written = False
+    for batch in batches:
+        if not header_written:
+            header = io.StringIO()
+            csv.writer(header).writerow(batch.schema.names)
+            yield header.getvalue().encode('utf-8')
+            header_written = True
+        metrics.count('rows', batch.num_rows)
+        yield encode_arrow_batch(batch, json_columns)
+
+def confirm_upload_mode(dataset: DatasetOperations, mode: str):
+    """
+    mig_dx_api only declares the replace and create upload modes, so ask DX for an upload url in
+    any other mode before exporting the table, rather than finding out once the data is ready to upload
+    """
+    if mode in DX_UPLOAD_MODES or mode in confirmed_upload_modes:
+        return
+    import httpx
+
+    try:
+        get_upload_url(dataset, mode=mode)
+    except httpx.HTTPStatusError as error:
+        raise Exception(f'DX does not accept upload mode {mode}: {error}') from error
+    confirmed_upload_modes.add(mode)
+
+def get_upload_url(dataset: DatasetOperations, is_resumable: bool = False, mode: str = 'replace'):
+    with metrics.span('upload_url'):
+        if is_resumable:
+            return dataset.get_upload_url(mode=mode, upload_type='resumable')
+
+        return dataset.get_upload_url(mode=mode)
+
+@functools.cache
+def get_http_adapter() -> requests.adapters.HTTPAdapter:
+    from requests.adapters import HTTPAdapter
+
+    return HTTPAdapter(pool_connections=HTTP_POOL_SIZE, pool_maxsize=HTTP_POOL_SIZE)
+
+def create_http_session(session: requests.Session = None) -> requests.Session:
+    """
+    Mount the shared connection pool on a session, so upload and BigQuery requests keep
+    their connections alive between chunks, stages and tables
+    """
+    import requests
+
+    session = session or requests.Session()
+    session.mount('https://', get_http_adapter())
+    session.mount('http://', get_http_adapter())
+    return session
+
+@functools.cache
+def get_http_session() -> requests.Session:
+    return create_http_session()
+
+def get_retry_delay(attempt: int) -> float:
+    """
+    Exponential backoff with full jitter
+    """
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt))
+
+def wait_before_retry(error: UploadError, attempt: int, max_retries: int):
+    """
+    Sleep before the next attempt, re-raising the error if it can't be retried
+    """
+    if not error.retryable or attempt > max_retries:
+        raise error
+    delay = get_retry_delay(attempt)
+    print(f'{get_formatted_date()} | {error}, retrying in {delay:.1f} seconds (attempt {attempt} of {max_retries})')
+    metrics.count('retries')
+    with metrics.span('retry_wait', attempt=attempt, status_code=error.status_code):
+        time.sleep(delay)
+
+def call_with_retries(upload_function, *args, max_retries: int = MAX_UPLOAD_RETRIES):
+    attempt = 0
+    while True:
+        try:
+            return upload_function(*args)
+        except UploadError as error:
+            attempt += 1
+            wait_before_retry(error, attempt, max_retries)
+
+def send_upload_request(upload_url: str, headers: dict, data: bytes | memoryview = None):
+    """
+    PUT to the upload url, raising UploadError for connection failures and unexpected responses
+    """
+    import requests
+
+    try:
+        response = get_http_session().put(upload_url['url'], headers=headers, data=data)
+    except (requests.ConnectionError, requests.Timeout) as error:
+        raise UploadError(f'Upload failed: {error}') from error
+    print(f'response: {response}')
+    if response.status_code not in [200, 201, 308]:
+        raise UploadError(f'Upload failed: {response.text}', response.status_code)
+    return response
+
+def get_committed_offset(response: requests.Response) -> int | None:
+    """
+    Offset of the first byte the server has not committed, or None once the upload is complete
+    """
+    if response.status_code in [200, 201]:
+        return None
+    # a 308 without a Range header means nothing has been committed yet
+    committed_range = response.headers.get('Range')
+    if not committed_range:
+        return 0
+    return int(committed_range.split('-')[-1]) + 1
+
+def get_upload_status(upload_url: str, total_size: int | str, digest: UploadDigest = None) -> int | None:
+    """
+    Ask the server how much of a resumable upload it has committed
+    """
+    with metrics.span('upload_status'):
+        response = send_upload_request(upload_url, {'Content-Range': f'bytes */{total_size}'})
+    committed_offset = get_committed_offset(response)
+    if committed_offset is None and digest is not None:
+        digest.verify(response)
+    return committed_offset
+
+def print_compression_fallback(compression: str):
+    """
+    GCS takes the Content-Encoding of a resumable upload from the request that starts the session, and DX
+    starts it without one, so a compressed resumable upload would be stored as gzip bytes labelled plain csv.
+    Data that needs a chunked upload is decompressed and sent as plain csv instead.
+    """
+    print(f'{compression} compression only works for uploads sent in a single request, '
+        f'this upload is larger than {CHUNK_SIZE} bytes after compression so it is sent uncompressed')
+    metrics.count('compression_fallbacks')
+
+def get_content_headers(compression: str = None) -> dict:
+    headers = {'Content-Type': 'text/csv'}
+    if compression:
+        # the bucket stores the object as gzip encoded csv and decompresses it for readers that need it
+        headers['Content-Encoding'] = compression
+    return headers
+
+def write_bytes_to_signed_url(
+    data: bytes | memoryview,
+    upload_url: str,
+    compression: str = None,
+    digest: UploadDigest = None):
+    """
+    Upload already encoded CSV data to presigned url in a single request. The hashes are only checked
+    against the response, extra headers would have to be part of the url signature.
+    """
+    with metrics.span('upload', size=len(data)):
+        response = call_with_retries(send_upload_request, upload_url, get_content_headers(compression), data)
+    metrics.count('bytes_sent', len(data))
     print(f'upload response: {response}')
+    if digest is not None:
+        digest.verify(response)
+
+def put_chunk(
+    upload_url: str,
+    chunk: bytes | memoryview,
+    start_byte: int,
+    total_size: int | str,
+    compression: str = None,
+    digest: UploadDigest = None) -> int | None:
+    """
+    Send a single chunk of a resumable upload, returns the next offset the server expects or None once complete.
+    The final chunk carries the hashes of the whole upload so the bucket rejects corrupted data,
+    the hashes are checked against the response as well.
+    """
+    end_byte = start_byte + len(chunk) - 1
+    headers = {
+        'Content-Range': f'bytes {start_byte}-{end_byte}/{total_size}',
+        **get_content_headers(compression)
+    }
+    if digest is not None and end_byte + 1 == total_size == digest.size:
+        headers['x-goog-hash'] = digest.get_hash_header()
+    print(f'{get_formatted_date()} | attempting to send {start_byte} to {end_byte} bytes')
+
+    # Upload the chunk
+    with metrics.span('upload_chunk', start_byte=start_byte, size=len(chunk)):
+        response = send_upload_request(upload_url, headers, chunk)
+    committed_offset = get_committed_offset(response)
+    metrics.count('chunks')
+    metrics.count('bytes_sent', len(chunk))
+
+    if committed_offset is None:
+        print('Upload complete.')
+        if digest is not None:
+            digest.verify(response)
+    else:
+        # 308 indicates that the upload is incomplete and we can continue
+        print(f'Uploaded bytes {start_byte} to {committed_offset - 1}')
+    return committed_offset
+
+def upload_chunk(
+    upload_url: str,
+    chunk: bytes | memoryview,
+    start_byte: int,
+    total_size: int | str,
+    compression: str = None,
+    max_retries: int = MAX_UPLOAD_RETRIES,
+    digest: UploadDigest = None) -> int | None:
+    """
+    Upload a chunk, retrying transient failures with backoff. After a failure or a partial commit the
+    upload status is used to resend only the part of the chunk the server doesn't have.
+    Returns the next offset the server expects, which falls outside the chunk if the server lost earlier data,
+    or None once the upload is complete.
+    """
+    end_offset = start_byte + len(chunk)
+    offset = start_byte
+    attempt = 0
+    needs_status = False
+    while start_byte <= offset < end_offset:
+        try:
+            if needs_status:
+                offset = get_upload_status(upload_url, total_size, digest)
+                needs_status = False
+                if offset is not None:
+                    print(f'{get_formatted_date()} | server has committed {offset} bytes')
+            else:
+                offset = put_chunk(upload_url, chunk[offset - start_byte:], offset, total_size, compression, digest)
+        except UploadError as error:
+            attempt += 1
+            wait_before_retry(error, attempt, max_retries)
+            # the failed request may have committed part of the chunk, so check before resending
+            needs_status = True
+            continue
+        if offset is None:
+            return None
+    return offset
+
+def get_checkpoint_path(checkpoint_dir: str, installation_id: int, dataset_id: str, table_name: str) -> str:
+    return os.path.join(checkpoint_dir, f'{installation_id}.{dataset_id}.{table_name}.json')
+
+def get_checkpoint_data_path(checkpoint_path: str) -> str:
+    """
+    Encoded data for a checkpointed upload is kept next to the checkpoint so a rerun doesn't query BigQuery again
+    """
+    return os.path.splitext(checkpoint_path)[0] + '.csv'
+
+def load_checkpoint(checkpoint_path: str) -> dict | None:
+    try:
+        with open(checkpoint_path) as checkpoint_file:
+            return json.load(checkpoint_file)
+    except FileNotFoundError:
+        return None
+
+def save_checkpoint(
+    checkpoint_path: str,
+    upload_url: str,
+    data_size: int,
+    offset: int,
+    table_state: dict = None,
+    compression: str = None,
+    upload_mode: str = 'replace'):
+    """
+    table_state is the sync state to save once the upload completes, so a resumed upload can save it too
+    """
+    checkpoint = {
+        'upload_url': upload_url,
+        'data_size': data_size,
+        'offset': offset,
+        'table_state': table_state,
+        'compression': compression,
+        'upload_mode': upload_mode,
+        'updated': get_formatted_date()
+    }
+    write_json_file(checkpoint_path, checkpoint)
+
+def update_checkpoint_offset(checkpoint_path: str, offset: int):
+    checkpoint = load_checkpoint(checkpoint_path)
+    checkpoint['offset'] = offset
+    checkpoint['updated'] = get_formatted_date()
+    write_json_file(checkpoint_path, checkpoint)
+
+def remove_checkpoint(checkpoint_path: str):
+    for path in [checkpoint_path, get_checkpoint_data_path(checkpoint_path)]:
+        if os.path.exists(path):
+            os.remove(path)
 
 def write_chunked_data(
-    data_buffer: io.StringIO,
-    approx_data_size: int,
+    data_buffer: SpillingBuffer,
+    data_size: int,
     upload_url: str,
-    chunk_size: int):
+    chunk_size: int,
+    start_byte: int = 0,
+    checkpoint_path: str = None,
+    compression: str = None,
+    chunk_sizer: ChunkSizer = None,
+    stop_byte: int = None) -> int | None:
     """
-    Write data from Portal source dataset to file in MIG landing bucket
+    Write data from Portal source dataset to file in MIG landing bucket,
+    a chunk_sizer replaces the fixed chunk_size. The upload is checked against the buffer's digest.
+    With stop_byte, an aligned offset before data_size, the upload stops there and returns the offset,
+    so the rest can be sent later. The object isn't created until the rest is sent.
     """
-    data_buffer.seek(0)
+    data_view = data_buffer.getbuffer()
+    digest = data_buffer.get_digest()
+    end_byte = data_size if stop_byte is None else stop_byte
 
-    # Track the start byte for each chunk
+    # Track the start byte for each chunk, the server decides where the next chunk starts
+    offset = start_byte
+    while offset < end_byte:
+        chunk = data_view[offset:min(offset + (chunk_sizer.size if chunk_sizer else chunk_size), end_byte)]
+        start_time = time.monotonic()
+        chunk_start = offset
+        offset = upload_chunk(upload_url, chunk, offset, data_size, compression, digest=digest)
+        if chunk_sizer:
+            chunk_sizer.record(len(chunk), time.monotonic() - start_time)
+        if offset is None:
+            if chunk_start + len(chunk) != data_size:
+                raise IntegrityError(
+                    f'Upload failed: server completed the upload at byte {chunk_start + len(chunk)} of {data_size}',
+                    chunk_start + len(chunk))
+            return
+        if offset > chunk_start + len(chunk):
+            raise IntegrityError(
+                f'Upload failed: server committed up to byte {offset} but only {chunk_start + len(chunk)} were sent',
+                chunk_start + len(chunk))
+        if checkpoint_path:
+            update_checkpoint_offset(checkpoint_path, offset)
+    if stop_byte is not None:
+        return offset
+    raise Exception(f'Upload did not complete after sending {data_size} bytes')
+
+def write_streamed_data(
+    chunks: Iterator[bytes],
+    upload_url: str,
+    compression: str = None,
+    chunk_sizer: ChunkSizer = None) -> int:
+    """
+    Write chunks to file in MIG landing bucket as they are encoded. The total size isn't known
+    until the last chunk is read, so earlier chunks are sent with an unknown (*) total.
+    The upload time of each chunk is recorded with chunk_sizer, which sizes the chunks still to be encoded.
+    The chunks are hashed as they are sent and the last chunk carries the hashes of the whole upload.
+    Returns the number of bytes sent.
+    """
+    digest = UploadDigest()
     start_byte = 0
+    chunk = next(chunks, None)
+    while chunk is not None:
+        # read one chunk ahead so the last chunk can be sent with the total size
+        next_chunk = next(chunks, None)
+        total_size = start_byte + len(chunk) if next_chunk is None else '*'
+        digest.update(chunk)
+        start_time = time.monotonic()
+        offset = upload_chunk(upload_url, chunk, start_byte, total_size, compression, digest=digest)
+        if chunk_sizer:
+            chunk_sizer.record(len(chunk), time.monotonic() - start_time)
+        if offset is None:
+            return start_byte + len(chunk)
+        if offset != start_byte + len(chunk):
+            # earlier chunks are gone once they have been sent, so they can't be sent again
+            raise IntegrityError(
+                f'Upload failed: server expects byte {offset} but streaming is at byte {start_byte + len(chunk)}',
+                min(offset, start_byte + len(chunk)))
+        start_byte = offset
+        chunk = next_chunk
+    raise Exception(f'Upload did not complete after sending {start_byte} bytes')
 
-    # Iterate over the buffered data by chunk
-    while True:
-        chunk = data_buffer.read(chunk_size)
-        if not chunk:
-            print('end of file, break')
-            break  # Break if the end of file is reached
-
-        end_byte = start_byte + len(chunk) - 1
-        headers = {
-            'Content-Range': f'bytes {start_byte}-{end_byte}/{approx_data_size}',
-            'Content-Type': 'text/csv',
-        }
-        print(f'{get_formatted_date()} | attempting to send {start_byte} to {end_byte} bytes')
-
-        # Upload the chunk
-        response = requests.put(upload_url['url'], headers=headers, data=chunk)
-        print(f'response: {response}')
-
-        if response.status_code in [200, 201]:
-            print('Upload complete.')
-            break  # Successfully uploaded the whole file
-        elif response.status_code == 308:
-            # 308 indicates that the upload is incomplete and we can continue
-            print(f'Uploaded bytes {start_byte} to {end_byte}')
-            start_byte = end_byte + 1
-        else:
-            # Handle upload failure
-            raise Exception(f'Upload failed: {response.text}')
+def resume_checkpointed_upload(checkpoint_path: str, chunk_size: int) -> dict | None:
+    """
+    Continue a chunked upload interrupted in an earlier run, returns the checkpoint once the upload
+    completes or None if there is nothing to resume
+    """
+    checkpoint = load_checkpoint(checkpoint_path)
+    data_path = get_checkpoint_data_path(checkpoint_path)
+    if checkpoint is None or not os.path.exists(data_path) or os.path.getsize(data_path) != checkpoint['data_size']:
+        return None
+
+    upload_url = checkpoint['upload_url']
+    data_size = checkpoint['data_size']
+    print(f'{get_formatted_date()} | found checkpoint at byte {checkpoint["offset"]} of {data_size}, resuming upload')
+    try:
+        offset = call_with_retries(get_upload_status, upload_url, data_size)
+    except UploadError as error:
+        if error.status_code not in [404, 410]:
+            raise
+        print('upload session has expired, starting over')
+        remove_checkpoint(checkpoint_path)
+        return None
+
+    if offset is not None:
+        with SpillingBuffer.from_file(data_path) as data_buffer:
+            write_chunked_data(
+                data_buffer, data_size, upload_url, chunk_size, offset, checkpoint_path, checkpoint.get('compression'))
+    remove_checkpoint(checkpoint_path)
+    return checkpoint
+
+def upload_streamed_data(
+    destination_dataset: DatasetOperations,
+    chunks: Iterator[bytes],
+    upload_mode: str = 'replace',
+    compression: str = None,
+    chunk_sizer: ChunkSizer = None,
+    allow_empty: bool = False) -> int:
+    """
+    Upload encoded chunks to MIG, tables that fit in a single chunk are sent all at once
+    and larger tables are streamed through a resumable upload. Returns the number of bytes sent,
+    with allow_empty nothing is uploaded when there are no chunks.
+    """
+    first_chunk = next(chunks, None)
+    if first_chunk is None:
+        if allow_empty:
+            return 0
+        raise Exception('No data found in source table')
+
+    second_chunk = next(chunks, None)
+    if second_chunk is None:
+        print(f'data size is {len(first_chunk)} bytes so sending all at once')
+        upload_url = get_upload_url(destination_dataset, mode=upload_mode)
+        digest = UploadDigest()
+        digest.update(first_chunk)
+        write_bytes_to_signed_url(first_chunk, upload_url, compression, digest)
+        return len(first_chunk)
+
+    print(f'data size is larger than {len(first_chunk)} bytes so streaming in chunks')
+    chunks = itertools.chain([first_chunk, second_chunk], chunks)
+    if compression:
+        print_compression_fallback(compression)
+        chunks = rechunk(iter_decompressed_blocks(chunks, compression), chunk_sizer or CHUNK_SIZE)
+        compression = None
+    resumable_url = get_upload_url(destination_dataset, True, upload_mode)
+    return write_streamed_data(chunks, resumable_url, compression, chunk_sizer)
+
+def upload_shards(
+    destination_dataset: DatasetOperations,
+    shard_buffers: list[SpillingBuffer],
+    upload_mode: str = 'append',
+    compression: str = None,
+    adaptive_chunks: bool = False) -> int:
+    """
+    Upload csv shards at the same time, each through a resumable upload of its own in upload_mode. Everything
+    but the final chunk of each shard is sent first, and a resumable upload only creates its object once its
+    final chunk is sent, so the dataset is left as it was unless every shard gets that far. Then the final
+    chunks are sent together. Shards can't replace a dataset, DX loads uploads in no known order and can't
+    confirm a replace has loaded, so appends sent after it could be wiped out by it.
+    When some final chunks fail after others went through PartialUploadError is raised.
+    Returns the number of bytes sent.
+    """
+    if upload_mode == 'replace':
+        raise Exception('Sharded uploads cannot replace a dataset, send a full sync as a single file')
+    table = metrics.get_table()
+    upload_urls = [get_upload_url(destination_dataset, True, upload_mode) for _ in shard_buffers]
+    chunk_sizers = [ChunkSizer(adaptive=adaptive_chunks) for _ in shard_buffers]
+    print(f'{get_formatted_date()} | uploading {len(shard_buffers)} shards of '
+        f'{", ".join(str(buffer.size) for buffer in shard_buffers)} bytes')
+
+    def send_shard(shard_index: int, start_byte: int = 0, stop_byte: int = None) -> int | None:
+        buffer = shard_buffers[shard_index]
+        with metrics.for_table(table):
+            return write_chunked_data(buffer, buffer.size, upload_urls[shard_index], CHUNK_SIZE, start_byte,
+                compression=compression, chunk_sizer=chunk_sizers[shard_index], stop_byte=stop_byte)
+
+    # hold back at least one byte of every shard, non-final chunks have to stay aligned
+    stop_bytes = [(buffer.size - 1) // UPLOAD_ALIGNMENT * UPLOAD_ALIGNMENT for buffer in shard_buffers]
+    with ThreadPoolExecutor(max_workers=len(shard_buffers)) as executor:
+        offsets = list(executor.map(send_shard, range(len(shard_buffers)), [0] * len(shard_buffers), stop_bytes))
+        print(f'{get_formatted_date()} | all shards sent, sending their final chunks')
+        with metrics.span('commit'):
+            futures = {
+                shard_index: executor.submit(send_shard, shard_index, offsets[shard_index])
+                for shard_index in range(len(shard_buffers))
+            }
+            errors = {shard_index: future.exception() for shard_index, future in futures.items() if future.exception()}
+    if errors:
+        first_error = next(iter(errors.values()))
+        if len(errors) == len(shard_buffers):
+            raise first_error
+        raise PartialUploadError(
+            f'Dataset {destination_dataset.name} is partially updated: {len(shard_buffers) - len(errors)} '
+            f'of {len(shard_buffers)} shards were uploaded, shards {", ".join(map(str, errors))} failed: {first_error}'
+        ) from first_error
+    metrics.count('shards', len(shard_buffers))
+    return sum(buffer.size for buffer in shard_buffers)
 
 def format_private_key(unformatted_key: str) -> str:
     """
@@ -178,71 +2070,597 @@ def format_private_key(unformatted_key: str) -> str:
         raise Exception('Private key is malformed')
     return f'{key_parts[1]}\n{key_parts[2]}\n{key_parts[3]}'
 
-def main(dataset_id: str, table_name: str, target_installation_id: str):
-    print(f'Source dataset: {dataset_id}.{table_name}')
+def upload_table_data(
+    client: bigquery.Client,
+    destination_dataset: DatasetOperations,
+    dataset_id: str,
+    table_name: str,
+    streaming: bool = False,
+    read_engine: str = 'json',
+    checkpoint_path: str = None,
+    incremental_sync: dict = None,
+    max_memory_size: int = SPILL_THRESHOLD,
+    table_state: dict = None,
+    compression: str = None,
+    read_streams: int = 1,
+    adaptive_chunks: bool = False,
+    columns: list[str] = None,
+    where: str = None,
+    shards: int = 1):
+    """
+    Export rows from the Portal source table and upload them to the MIG dataset,
+    table_state is saved with the checkpoint of a chunked upload. Buffered incremental exports
+    can be split into shards that are uploaded at the same time, without a checkpoint,
+    a full sync still replaces the dataset with a single file.
+    An incremental export can find no rows when the watermark only moved on rows the filter excludes,
+    then nothing is uploaded. Returns the number of bytes uploaded.
+    """
+    row_filter = combine_row_filters(where, incremental_sync['row_filter'] if incremental_sync else None)
+    query_parameters = incremental_sync['query_parameters'] if incremental_sync else None
+    upload_mode = incremental_sync['upload_mode'] if incremental_sync else 'replace'
+    allow_empty = upload_mode != 'replace'
+    chunk_sizer = ChunkSizer(adaptive=adaptive_chunks)
+
+    if read_engine == 'arrow' or streaming:
+        if read_engine == 'arrow':
+            # Arrow batches are encoded column-wise and always streamed to MIG
+            batches, json_columns = iter_source_batches(
+                client, dataset_id, table_name, row_filter, query_parameters, read_streams, columns)
+            blocks = iter_arrow_csv_blocks(metrics.timed('fetch', batches), json_columns)
+        else:
+            # Encode and upload rows as they are fetched so memory is bounded by a few chunks
+            fields = get_source_fields(client, dataset_id, table_name, columns)
+            rows = metrics.timed('fetch', iter_source_data(
+                client, dataset_id, table_name, row_filter, query_parameters, read_streams, columns))
+            blocks = iter_csv_blocks(rows, fields)
+        # the next chunk is fetched and encoded on another thread while the current one uploads
+        blocks = iter_compressed_blocks(blocks, compression)
+        chunks = iter_prefetched(metrics.timed('encode', rechunk(blocks, chunk_sizer)))
+        data_size = upload_streamed_data(destination_dataset, metrics.timed('encode_wait', chunks),
+            upload_mode, compression, chunk_sizer, allow_empty)
+        metrics.count('bytes_encoded', data_size)
+        print(f'{get_formatted_date()} | streamed {data_size} bytes')
+        return data_size
 
-    # Initialize the mig client
-    private_key = format_private_key(os.environ.get('PRIVATE_KEY'))
-    dx = DX(app_id=os.environ.get('APP_ID'), private_key=private_key)
-    if os.environ.get('BASE_URL'):
-        dx.base_url = os.environ.get('BASE_URL')
-    user_info = dx.whoami()
-    print(f'user info: {user_info}\n')
+    # Get data from source dataset, the csv columns and their formatting follow its schema
+    fields = get_source_fields(client, dataset_id, table_name, columns)
+    source_data = metrics.timed('fetch', iter_source_data(
+        client, dataset_id, table_name, row_filter, query_parameters, read_streams, columns))
 
-    # Initialize the google bigquery client
-    credentials, project = google.auth.default(
-        scopes=[
-            'https://www.googleapis.com/auth/bigquery',
-        ]
-    )
-    print(f'bigquery project: {project}')
-    client = bigquery.Client(credentials=credentials, project=project)
+    if shards > 1 and upload_mode == 'replace':
+        print(f'{dataset_id}.{table_name} is fully synced, sending it as a single file instead of {shards} shards')
+    elif shards > 1:
+        with metrics.span('encode'):
+            shard_buffers = create_shard_buffers(source_data, shards, max_memory_size, compression, fields)
+        with contextlib.ExitStack() as stack:
+            for buffer in shard_buffers:
+                stack.enter_context(buffer)
+            data_size = sum(buffer.size for buffer in shard_buffers)
+            metrics.count('bytes_encoded', data_size)
+            print(f'{get_formatted_date()} | data size: {data_size} bytes')
+            if data_size == 0 and not allow_empty:
+                raise Exception('No data found in source table')
+            if data_size == 0:
+                print(f'No rows to upload from {dataset_id}.{table_name}')
+            else:
+                upload_shards(destination_dataset, shard_buffers, upload_mode, compression, adaptive_chunks)
+        return data_size
 
-    # Check if dataset of specified name already exists
-    installations = dx.get_installations()
+    # Create buffer of data for writing to mig bucket (so size can be checked),
+    # checkpointed uploads keep all of the data on disk so a rerun can resume from it
+    with metrics.span('encode'):
+        if checkpoint_path:
+            data_buffer = create_data_buffer(
+                source_data, 0, get_checkpoint_data_path(checkpoint_path), compression, fields)
+        else:
+            data_buffer = create_data_buffer(source_data, max_memory_size, compression=compression, fields=fields)
+    with contextlib.ExitStack() as stack:
+        stack.enter_context(data_buffer)
+        # size of the encoded file in bytes
+        data_size = data_buffer.size
+        metrics.count('bytes_encoded', data_size)
+        print(f'{get_formatted_date()} | data size: {data_size} bytes')
+        if data_size == 0 and not allow_empty:
+            raise Exception('No data found in source table')
 
-    installation = get_target_installation(installations, target_installation_id)
+        # get upload url and write data to MIG bucket
+        if data_size == 0:
+            print(f'No rows to upload from {dataset_id}.{table_name}')
+        elif data_size > CHUNK_SIZE:
+            print(f'data size is larger than {CHUNK_SIZE} bytes so sending in chunks')
+            if compression:
+                print_compression_fallback(compression)
+                with metrics.span('decompress'):
+                    data_buffer = stack.enter_context(decompress_data_buffer(data_buffer, compression,
+                        max_memory_size, get_checkpoint_data_path(checkpoint_path) if checkpoint_path else None))
+                data_size = data_buffer.size
+                compression = None
+            resumable_url = get_upload_url(destination_dataset, True, upload_mode)
+            if checkpoint_path:
+                save_checkpoint(checkpoint_path, resumable_url, data_size, 0, table_state, compression, upload_mode)
+            write_chunked_data(
+                data_buffer,
+                data_size,
+                resumable_url,
+                CHUNK_SIZE,
+                checkpoint_path=checkpoint_path,
+                compression=compression,
+                chunk_sizer=chunk_sizer
+            )
+        else:
+            print(f'data size is smaller than {CHUNK_SIZE} bytes so sending all at once')
+            upload_url = get_upload_url(destination_dataset, mode=upload_mode)
+            write_bytes_to_signed_url(data_buffer.getbuffer(), upload_url, compression, data_buffer.get_digest())
 
-    print(f'target installation found: {installation}')
+    if checkpoint_path:
+        remove_checkpoint(checkpoint_path)
+    return data_size
 
-    with dx.installation(installation) as ctx:
+@contextlib.contextmanager
+def invalidate_on_failure(metadata_cache: MetadataCache | None, dx: DX, keys: list[str]):
+    """
+    Drop the cached lookups a failed sync relied on, so the next run looks them up again.
+    A failed DX request could be caused by any cached DX entry, such as an expired token or a deleted dataset.
+    """
+    try:
+        yield
+    except Exception as error:
+        if metadata_cache is not None:
+            import httpx
+
+            if isinstance(error, httpx.HTTPStatusError):
+                keys = [*keys, get_dx_cache_key(dx, '')]
+            for key in keys:
+                metadata_cache.invalidate(key)
+        raise
+
+def sync_table(
+    dx: DX,
+    client: bigquery.Client,
+    project: str,
+    installation: Installation,
+    dataset_id: str,
+    table_name: str,
+    streaming: bool = False,
+    read_engine: str = 'json',
+    checkpoint_dir: str = None,
+    watermark_column: str = None,
+    incremental_mode: str = 'upsert',
+    state_file: str = STATE_FILE,
+    max_memory_size: int = SPILL_THRESHOLD,
+    skip_unchanged: bool = False,
+    verify_checksum: bool = False,
+    compression: str = None,
+    read_streams: int = 1,
+    adaptive_chunks: bool = False,
+    metadata_cache: MetadataCache = None,
+    columns: list[str] = None,
+    where: str = None,
+    shards: int = 1):
+    """
+    Sync a Portal source table to the MIG dataset of the same name, optionally limited to
+    some of its columns and the rows matching a filter
+    """
+    cache_keys = [
+        get_dataset_cache_key(dx, installation, table_name),
+        get_schema_cache_key(project, dataset_id, table_name, columns)
+    ]
+    with metrics.span('table', table=table_name), invalidate_on_failure(metadata_cache, dx, cache_keys):
+        print(f'Source dataset: {dataset_id}.{table_name}')
+        state_key = get_state_key(installation.installation_id, dataset_id, table_name)
+
+        # Continue an upload interrupted in an earlier run before querying BigQuery again
+        checkpoint_path = None
+        if checkpoint_dir:
+            os.makedirs(checkpoint_dir, exist_ok=True)
+            checkpoint_path = get_checkpoint_path(checkpoint_dir, installation.installation_id, dataset_id, table_name)
+            with metrics.span('resume'):
+                checkpoint = resume_checkpointed_upload(checkpoint_path, CHUNK_SIZE)
+            if checkpoint:
+                full_sync = checkpoint.get('upload_mode', 'replace') == 'replace'
+                if checkpoint.get('table_state') or full_sync:
+                    save_table_state(state_file, state_key, checkpoint.get('table_state') or {}, full_sync)
+                return
+
+        with dx.installation(installation) as ctx:
+            dataset_created = False
+            try:
+                with metrics.span('dataset_lookup'):
+                    destination_dataset = find_dataset(ctx, table_name, metadata_cache)
+            except KeyError:
+                print(f'Did not find dataset with name {table_name}. Creating...')
+                # If dataset doesn't exist, get schema of source table and create MIG dataset
+                with metrics.span('schema'):
+                    schema = get_cached_schema(client, table_name, dataset_id, project, metadata_cache, columns)
+                with metrics.span('dataset_create'):
+                    destination_dataset = create_dataset(ctx, table_name, schema)
+                if metadata_cache:
+                    metadata_cache.set(
+                        get_dataset_cache_key(dx, installation, table_name), dump_dataset(destination_dataset._dataset))
+                dataset_created = True
+
+            print(f'Found dataset with name {table_name}. Updating...')
+
+            previous_state = None if dataset_created else load_sync_state(state_file).get(state_key)
+
+            # Skip tables that haven't changed since the last successful sync
+            table_fingerprint = None
+            if skip_unchanged:
+                with metrics.span('fingerprint'):
+                    table_fingerprint = get_table_fingerprint(
+                        client, dataset_id, table_name, verify_checksum, columns, where)
+                if table_fingerprint and previous_state and previous_state.get('table_fingerprint') == table_fingerprint:
+                    print(f'{dataset_id}.{table_name} has not changed since the last sync, skipping')
+                    return
+
+            # Only export rows changed since the last sync when a watermark column is set,
+            # a new destination dataset always gets every row
+            incremental_sync = None
+            if watermark_column:
+                if previous_state is not None:
+                    # Check DX takes the incremental mode before the watermark query is paid for. The probe has
+                    # a side effect on the DX side, it asks for a real upload url, so it runs once per mode per run
+                    confirm_upload_mode(destination_dataset, incremental_mode)
+                with metrics.span('plan'):
+                    incremental_sync = plan_incremental_sync(client, dataset_id, table_name,
+                        watermark_column, incremental_mode, previous_state, columns, where)
+                if incremental_sync is None:
+                    print(f'No new rows in {dataset_id}.{table_name} since the last sync')
+                    return
+
+            table_state = dict(incremental_sync['state']) if incremental_sync else {}
+            if table_fingerprint:
+                table_state['table_fingerprint'] = table_fingerprint
+            # a full sync replaces the saved state, incremental syncs add to it
+            full_sync = incremental_sync is None or incremental_sync['upload_mode'] == 'replace'
+
+            upload_table_data(
+                client,
+                destination_dataset,
+                dataset_id,
+                table_name,
+                streaming,
+                read_engine,
+                checkpoint_path,
+                incremental_sync,
+                max_memory_size,
+                table_state,
+                compression,
+                read_streams,
+                adaptive_chunks,
+                columns,
+                where,
+                shards
+            )
+
+            if table_state or full_sync:
+                save_table_state(state_file, state_key, table_state, full_sync)
+
+def sync_table_with_result(
+    dx: DX,
+    client: bigquery.Client,
+    project: str,
+    installation: Installation,
+    dataset_id: str,
+    table_name: str,
+    **sync_options) -> dict:
+    """
+    Run sync_table, catching failures so one table doesn't stop the rest of a batch
+    """
+    start_time = time.monotonic()
+    try:
+        sync_table(dx, client, project, installation, dataset_id, table_name, **sync_options)
+        result = {'table_name': table_name, 'status': 'succeeded', 'error': None}
+    except Exception as error:
+        print(f'{get_formatted_date()} | sync of {table_name} failed: {error}')
+        result = {'table_name': table_name, 'status': 'failed', 'error': str(error)}
+    result['seconds'] = round(time.monotonic() - start_time, 3)
+    return result
+
+def sync_tables(
+    dx: DX,
+    client: bigquery.Client,
+    project: str,
+    installation: Installation,
+    dataset_id: str,
+    table_names: list[str],
+    max_workers: int = 1,
+    **sync_options) -> list[dict]:
+    """
+    Sync several tables with a bounded pool of worker threads sharing the BigQuery client and upload session,
+    each worker has a DX client of its own. Returns a result for each table, in the order the tables were given.
+    """
+    worker = WorkerDX(dx)
+
+    def sync_on_worker(table_name: str) -> dict:
+        return sync_table_with_result(worker.dx, client, project, installation, dataset_id, table_name, **sync_options)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(sync_on_worker, table_name) for table_name in table_names]
+        return [future.result() for future in futures]
+
+def print_sync_summary(results: list[dict]):
+    succeeded = [result for result in results if result['status'] == 'succeeded']
+    print(f'{get_formatted_date()} | synced {len(succeeded)} of {len(results)} tables')
+    for result in results:
+        error = f' ({result["error"]})' if result['error'] else ''
+        print(f'  {result["table_name"]}: {result["status"]} in {result["seconds"]}s{error}')
+
+def get_table_modified(client: bigquery.Client, dataset_id: str, table_name: str) -> datetime.datetime | None:
+    return client.get_table(f'{dataset_id}.{table_name}').modified
+
+def poll_changed_tables(
+    client: bigquery.Client,
+    dataset_id: str,
+    table_names: list[str],
+    last_modified: dict) -> list[str]:
+    """
+    Tables whose modified time differs from the one in last_modified, which is updated with the new times.
+    Tables that haven't been seen yet count as changed. A table that can't be read is left for the next poll.
+    """
+    changed_tables = []
+    for table_name in table_names:
         try:
-            destination_dataset = ctx.datasets.find(name=table_name)
-        except KeyError:
-            print(f'Did not find dataset with name {table_name}. Creating...')
-            # If dataset doesn't exist, get schema of source table and create MIG dataset
-            schema = get_schema(client, table_name, dataset_id, project)
-            destination_dataset = create_dataset(dx, installation, table_name, schema)
+            modified = get_table_modified(client, dataset_id, table_name)
+        except Exception as error:
+            print(f'{get_formatted_date()} | could not read metadata of {dataset_id}.{table_name}: {error}')
+            continue
+        if table_name not in last_modified or last_modified[table_name] != modified:
+            last_modified[table_name] = modified
+            changed_tables.append(table_name)
+    metrics.count('watch_polls')
+    return changed_tables
 
-        print(f'Found dataset with name {table_name}. Updating...')
+def watch_tables(
+    dx: DX,
+    client: bigquery.Client,
+    project: str,
+    installation: Installation,
+    dataset_id: str,
+    table_names: list[str],
+    max_workers: int = 1,
+    interval: float = WATCH_INTERVAL,
+    jitter: float = WATCH_JITTER,
+    max_polls: int = None,
+    **sync_options) -> list[dict]:
+    """
+    Keep polling the modified time of the tables and sync each table when it changes, reusing the BigQuery
+    client, upload session and the DX client of each worker between syncs. Every table is synced on the first poll.
+    At most max_workers syncs run at the same time, and a table isn't synced again while its last sync runs.
+    Polls and the syncs they trigger start after a random delay of up to jitter seconds, so tables
+    that change together don't all hit the upload endpoint at once. Runs until interrupted or
+    for max_polls polls, then waits for the running syncs and returns the latest result of each table.
+    Only the latest result is kept so a long running watch doesn't grow, earlier syncs are in the metrics.
+    """
+    last_modified = {}
+    running = {}
+    results = {}
+    worker = WorkerDX(dx)
 
-        # Get data from source dataset
-        source_data = get_source_data(client, dataset_id, table_name)
+    def sync_after_delay(table_name: str) -> dict:
+        time.sleep(random.uniform(0, jitter))
+        return sync_table_with_result(worker.dx, client, project, installation, dataset_id, table_name, **sync_options)
 
-        # Create buffer of data for writing to mig bucket (so size can be checked)
-        data_buffer = create_data_buffer(source_data)
+    def collect_results():
+        for table_name, future in list(running.items()):
+            if not future.done():
+                continue
+            result = running.pop(table_name).result()
+            if result['status'] == 'failed':
+                # try again on the next poll even if the table doesn't change
+                last_modified.pop(table_name, None)
+                metrics.count('watch_failures')
+            print(f'{get_formatted_date()} | {table_name} {result["status"]} in {result["seconds"]}s')
+            results[table_name] = result
 
-        # estimate size of file based on number of characters
-        approx_data_size = data_buffer.tell()
-        print(f'{get_formatted_date()}| data size: {approx_data_size} bytes')
+    print(f'{get_formatted_date()} | watching {len(table_names)} tables in {dataset_id} every {interval}s')
+    poll_count = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            while max_polls is None or poll_count < max_polls:
+                if poll_count:
+                    time.sleep(interval + random.uniform(0, jitter))
+                collect_results()
+                # a table that is still syncing is compared again on the next poll
+                pending_tables = [table_name for table_name in table_names if table_name not in running]
+                for table_name in poll_changed_tables(client, dataset_id, pending_tables, last_modified):
+                    print(f'{get_formatted_date()} | {dataset_id}.{table_name} changed, syncing')
+                    metrics.count('watch_syncs')
+                    running[table_name] = executor.submit(sync_after_delay, table_name)
+                poll_count += 1
+        except KeyboardInterrupt:
+            print(f'{get_formatted_date()} | stopping, waiting for {len(running)} running syncs')
+        for future in running.values():
+            future.result()
+        collect_results()
+    return [results[table_name] for table_name in table_names if table_name in results]
 
-        # get upload url and write data to MIG bucket
-        if approx_data_size > CHUNK_SIZE:
-            print(f'data size is larger than {CHUNK_SIZE} bytes so sending in chunks')
-            resumable_url = get_upload_url(destination_dataset, True)
-            write_chunked_data(data_buffer, approx_data_size, resumable_url, CHUNK_SIZE)
-        else:
-            print(f'data size is smaller than {CHUNK_SIZE} bytes so sending all at once')
-            upload_url = get_upload_url(destination_dataset)
-            write_data_to_signed_url(source_data, destination_dataset, upload_url)
+def get_dataset_table_names(client: bigquery.Client, dataset_id: str) -> list[str]:
+    return [table.table_id for table in client.list_tables(dataset_id)]
+
+def main(
+    dataset_id: str,
+    table_names: list[str],
+    target_installation_id: str,
+    all_tables: bool = False,
+    max_workers: int = 1,
+    metadata_cache: MetadataCache = None,
+    dry_run: bool = False,
+    watch: bool = False,
+    watch_interval: float = WATCH_INTERVAL,
+    watch_jitter: float = WATCH_JITTER,
+    **sync_options):
+    # Initialize the mig client, a dry run only talks to BigQuery
+    if not dry_run:
+        with metrics.span('auth', service='dx'):
+            private_key = format_private_key(os.environ.get('PRIVATE_KEY'))
+            dx = get_cached_dx_class()(metadata_cache, app_id=os.environ.get('APP_ID'), private_key=private_key)
+            if os.environ.get('BASE_URL'):
+                dx.base_url = os.environ.get('BASE_URL')
+            user_info = dx.whoami()
+        print(f'user info: {user_info}\n')
+
+    # Initialize the google bigquery client
+    with metrics.span('auth', service='bigquery'):
+        import google.auth
+        from google.auth.transport.requests import AuthorizedSession
+        from google.cloud import bigquery
+
+        credentials, project = google.auth.default(
+            scopes=[
+                'https://www.googleapis.com/auth/bigquery',
+            ]
+        )
+        # BigQuery requests share the connection pool of the uploads
+        client = bigquery.Client(
+            credentials=credentials, project=project, _http=create_http_session(AuthorizedSession(credentials)))
+    print(f'bigquery project: {project}')
+
+    if all_tables:
+        table_names = get_dataset_table_names(client, dataset_id)
+        print(f'found {len(table_names)} tables in {dataset_id}')
+
+    if dry_run:
+        if sync_options.get('watermark_column'):
+            print('dry run estimates a full export, watermark filters are only planned by a sync')
+        for table_name in table_names:
+            with metrics.span('table', table=table_name):
+                estimate_table_export(
+                    client, dataset_id, table_name, sync_options.get('columns'), sync_options.get('where'))
+        return
+
+    # Check if dataset of specified name already exists
+    with metrics.span('installations'):
+        installations = dx.get_installations()
+
+    try:
+        installation = get_target_installation(installations, target_installation_id)
+    except Exception:
+        if metadata_cache is None:
+            raise
+        # the installations may have changed since they were cached
+        dx.invalidate_cache()
+        installation = get_target_installation(dx.get_installations(), target_installation_id)
+
+    print(f'target installation found: {installation}')
+
+    if watch:
+        watch_tables(dx, client, project, installation, dataset_id, table_names, max_workers,
+            watch_interval, watch_jitter, metadata_cache=metadata_cache, **sync_options)
+        return
+
+    if len(table_names) == 1:
+        sync_table(dx, client, project, installation, dataset_id, table_names[0],
+            metadata_cache=metadata_cache, **sync_options)
+        return
+
+    results = sync_tables(dx, client, project, installation, dataset_id, table_names, max_workers,
+        metadata_cache=metadata_cache, **sync_options)
+    print_sync_summary(results)
+    failed = [result for result in results if result['status'] == 'failed']
+    if failed:
+        raise Exception(f'{len(failed)} of {len(results)} tables failed to sync')
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--dataset_id', dest='dataset_id', type=str, help='Source dataset id', required=True)
-    parser.add_argument('--table_name', dest='table_name', type=str,
-        help='Source table name, also used to name destination dataset', required=True)
+    tables = parser.add_mutually_exclusive_group(required=True)
+    tables.add_argument('--table_name', dest='table_names', type=str, action='append',
+        help='Source table name, also used to name destination dataset. Repeat to sync several tables')
+    tables.add_argument('--all_tables', dest='all_tables', action='store_true',
+        help='Sync every table in the source dataset')
     parser.add_argument('--installation_id', dest='target_installation_id', type=str,
         help='Target installation id (optional when there is only one installation)', required=False)
+    parser.add_argument('--max_workers', dest='max_workers', type=int, default=4,
+        help='Number of tables synced at the same time when syncing several tables (default 4)')
+    parser.add_argument('--max_table_memory_mb', dest='max_table_memory_mb', type=int,
+        default=SPILL_THRESHOLD // (1024 * 1024),
+        help='Memory each table can use for buffered data before spilling to disk, in MiB')
+    parser.add_argument('--streaming', dest='streaming', action='store_true',
+        help='Stream rows from BigQuery to MIG in chunks so memory use does not grow with table size')
+    parser.add_argument('--read_engine', dest='read_engine', type=str, choices=['json', 'arrow'], default='json',
+        help='Read rows as json strings (default) or as arrow record batches encoded column-wise (requires pyarrow)')
+    parser.add_argument('--read_streams', dest='read_streams', type=int, default=1,
+        help='Number of pages of query results fetched at the same time for each table (default 1)')
+    parser.add_argument('--adaptive_chunks', dest='adaptive_chunks', action='store_true',
+        help='Grow upload chunks on fast links and shrink them on slow or flaky ones, instead of a fixed 16 MiB')
+    parser.add_argument('--shards', dest='shards', type=int, default=1,
+        help='Split the rows of each incremental sync into this many csv files that are uploaded at the same time '
+            '(default 1). Full syncs replace the dataset with a single file, DX can\'t confirm a replace has loaded '
+            'before files appended to it (needs --watermark_column, json read engine in buffered mode only)')
+    parser.add_argument('--compression', dest='compression', type=str, choices=['gzip'], required=False,
+        help=f'Compress the csv on the fly before uploading it, tables that compress to more than '
+            f'{CHUNK_SIZE // (1024 * 1024)} MiB need a chunked upload and are sent uncompressed')
+    parser.add_argument('--checkpoint_dir', dest='checkpoint_dir', type=str, required=False,
+        help='Directory for upload checkpoints, a rerun continues an interrupted chunked upload (buffered mode only)')
+    parser.add_argument('--watermark_column', dest='watermark_column', type=str, required=False,
+        help='Only sync rows where this column is newer than at the last sync, e.g. updated_at')
+    parser.add_argument('--incremental_mode', dest='incremental_mode', type=str, choices=['upsert', 'append'],
+        default='upsert', help='Upload mode for incremental syncs, upsert requires a primary key on the source table')
+    parser.add_argument('--state_file', dest='state_file', type=str, default=STATE_FILE,
+        help=f'File that keeps sync state such as watermarks between runs (default {STATE_FILE})')
+    parser.add_argument('--skip_unchanged', dest='skip_unchanged', action='store_true',
+        help='Skip tables whose BigQuery metadata has not changed since the last successful sync')
+    parser.add_argument('--verify_checksum', dest='verify_checksum', action='store_true',
+        help='With --skip_unchanged, also compare a checksum of the table contents (scans the table)')
+    parser.add_argument('--columns', dest='columns', type=str, required=False,
+        help='Comma separated columns to export, in order (default every column)')
+    parser.add_argument('--where', dest='where', type=str, required=False,
+        help='Only export rows matching this BigQuery SQL condition, e.g. "created_at >= \'2024-01-01\'"')
+    parser.add_argument('--dry_run', dest='dry_run', action='store_true',
+        help='Estimate the bytes each export would scan and upload with a BigQuery dry run, without moving data')
+    parser.add_argument('--watch', dest='watch', action='store_true',
+        help='Keep running and sync each table whenever its BigQuery modified time changes, '
+            'at most --max_workers at a time')
+    parser.add_argument('--watch_interval', dest='watch_interval', type=float, default=WATCH_INTERVAL,
+        help=f'Seconds between polls of table metadata in watch mode (default {WATCH_INTERVAL})')
+    parser.add_argument('--watch_jitter', dest='watch_jitter', type=float, default=WATCH_JITTER,
+        help=f'Most extra seconds added at random to each poll and the syncs it starts (default {WATCH_JITTER})')
+    parser.add_argument('--cache_file', dest='cache_file', type=str, default=CACHE_FILE,
+        help=f'File that caches DX installations, datasets and tokens and BigQuery schemas (default {CACHE_FILE})')
+    parser.add_argument('--cache_ttl', dest='cache_ttl', type=int, default=CACHE_TTL,
+        help=f'Seconds cached lookups are kept for, 0 turns the cache off (default {CACHE_TTL})')
+    parser.add_argument('--metrics_file', dest='metrics_file', type=str, default=METRICS_FILE,
+        help=f'File for the json summary of stage timings and counters written at exit (default {METRICS_FILE})')
+    parser.add_argument('--metrics_log', dest='metrics_log', type=str, required=False,
+        help='Also log every timed span as a json line to this file')
     args = parser.parse_args()
-    # Pass in name of BigQuery dataset from ScriptRunner
-    main(args.dataset_id, args.table_name, args.target_installation_id)
+    if args.shards < 1:
+        parser.error('--shards must be at least 1')
+    if args.shards > 1 and (args.streaming or args.read_engine == 'arrow' or args.checkpoint_dir or args.compression):
+        parser.error('--shards cannot be used with --streaming, --read_engine arrow, --checkpoint_dir or --compression')
+    if args.shards > 1 and not args.watermark_column:
+        parser.error('--shards only splits incremental syncs, it needs --watermark_column')
+    metrics.log_path = args.metrics_log
+    try:
+        # Pass in name of BigQuery dataset from ScriptRunner
+        main(
+            args.dataset_id,
+            args.table_names,
+            args.target_installation_id,
+            all_tables=args.all_tables,
+            max_workers=args.max_workers,
+            metadata_cache=MetadataCache(args.cache_file, args.cache_ttl) if args.cache_ttl > 0 else None,
+            dry_run=args.dry_run,
+            watch=args.watch,
+            watch_interval=args.watch_interval,
+            watch_jitter=args.watch_jitter,
+            streaming=args.streaming,
+            read_engine=args.read_engine,
+            checkpoint_dir=args.checkpoint_dir,
+            watermark_column=args.watermark_column,
+            incremental_mode=args.incremental_mode,
+            state_file=args.state_file,
+            max_memory_size=args.max_table_memory_mb * 1024 * 1024,
+            skip_unchanged=args.skip_unchanged,
+            verify_checksum=args.verify_checksum,
+            compression=args.compression,
+            read_streams=args.read_streams,
+            adaptive_chunks=args.adaptive_chunks,
+            shards=args.shards,
+            columns=[column.strip() for column in args.columns.split(',')] if args.columns else None,
+            where=args.where
+        )
+    finally:
+        metrics.write_summary(args.metrics_file)
+        print(f'{get_formatted_date()} | metrics summary written to {args.metrics_file}')
@@ -0,0 +1,109 @@
+import base64
+import gzip
+import hashlib
+import json
+import pytest
+from unittest.mock import patch
+
+from benchmark import (
+    ResumableUploadServer,
+    FakeBigQueryClient,
+    RESUMABLE_ALIGNMENT,
+    generate_json_rows,
+    find_regressions,
+    run_benchmark
+)
+from run import (
+    IntegrityError,
+    UploadError,
+    get_source_data,
+    create_data_buffer,
+    iter_csv_blocks,
+    iter_compressed_blocks,
+    rechunk,
+    write_bytes_to_signed_url,
+    write_chunked_data,
+    write_streamed_data
+)
+
+def test_generate_json_rows():
+    rows = generate_json_rows(50, 6, unicode_ratio=1.0)
+    assert len(rows) == 50
+    assert rows == generate_json_rows(50, 6, unicode_ratio=1.0)
+    assert list(json.loads(rows[0]).keys()) == ['id', 'column_1', 'column_2', 'column_3', 'column_4', 'column_5']
+    assert any(not row.isascii() for row in rows)
+
+def test_fake_bigquery_client():
+    rows = generate_json_rows(10, 3)
+    source_data = get_source_data(FakeBigQueryClient(rows), 'dataset', 'table')
+    assert source_data == [json.loads(row) for row in rows]
+
+def test_upload_server_chunked():
+    source_data = [json.loads(row) for row in generate_json_rows(6000, 8, unicode_ratio=0.5)]
+    data_buffer = create_data_buffer(source_data)
+    with ResumableUploadServer(strict_alignment=True) as server:
+        write_chunked_data(data_buffer, data_buffer.size, server.get_upload_url('table'), RESUMABLE_ALIGNMENT)
+        upload = server.get_upload('table')
+    assert data_buffer.size > RESUMABLE_ALIGNMENT * 2
+    assert upload['committed'] == upload['total_size'] == data_buffer.size
+    assert bytes(upload['data']) == data_buffer.getvalue()
+
+@patch('time.sleep')
+def test_upload_server_failures_and_partial_commits(mock_sleep):
+    source_data = [json.loads(row) for row in generate_json_rows(12000, 8)]
+    blocks = iter_compressed_blocks(iter_csv_blocks(source_data), 'gzip')
+    with ResumableUploadServer(fail_every=3, partial_commit=True, strict_alignment=True) as server:
+        data_size = write_streamed_data(
+            rechunk(blocks, RESUMABLE_ALIGNMENT * 2), server.get_upload_url('table'), 'gzip')
+        upload = server.get_upload('table')
+    assert mock_sleep.call_count > 0
+    assert upload['committed'] == data_size
+    expected_buffer = create_data_buffer(source_data)
+    assert gzip.decompress(bytes(upload['data'])) == expected_buffer.getvalue()
+
+def test_upload_server_hashes():
+    source_data = [json.loads(row) for row in generate_json_rows(6000, 8)]
+    data_buffer = create_data_buffer(source_data)
+    with ResumableUploadServer(partial_commit=True, strict_alignment=True) as server:
+        write_chunked_data(data_buffer, data_buffer.size, server.get_upload_url('table'), RESUMABLE_ALIGNMENT * 2)
+        upload = server.get_upload('table')
+    md5 = base64.b64encode(hashlib.md5(data_buffer.getvalue()).digest()).decode('ascii')
+    # only the final chunk carries the hashes of the whole upload
+    hash_headers = [headers.get('x-goog-hash') for headers in upload['headers']]
+    assert hash_headers[:-1] == [None] * (len(hash_headers) - 1)
+    assert hash_headers[-1].startswith('crc32c=') and hash_headers[-1].endswith(f',md5={md5}')
+
+@patch('time.sleep')
+def test_upload_server_corruption(mock_sleep):
+    source_data = [json.loads(row) for row in generate_json_rows(6000, 8)]
+    data_buffer = create_data_buffer(source_data)
+    with ResumableUploadServer(corrupt_byte=RESUMABLE_ALIGNMENT + 10) as server:
+        with pytest.raises(UploadError) as upload_error:
+            write_chunked_data(data_buffer, data_buffer.size, server.get_upload_url('chunked'), RESUMABLE_ALIGNMENT)
+        with pytest.raises(IntegrityError, match=f'bytes 0-{data_buffer.size - 1}'):
+            write_bytes_to_signed_url(
+                data_buffer.getbuffer(), server.get_upload_url('single'), digest=data_buffer.get_digest())
+    assert upload_error.value.status_code == 400
+    mock_sleep.assert_not_called()
+
+def test_run_benchmark():
+    results = run_benchmark(500, 5, unicode_ratio=0.2, chunk_size=RESUMABLE_ALIGNMENT)
+    assert [metrics['stage'] for metrics in results] == ['fetch', 'encode', 'upload', 'stream']
+    assert results[1]['bytes'] == results[2]['bytes'] == results[3]['bytes']
+    assert all(metrics['peak_mb'] is not None for metrics in results)
+    # the encode stage holds the whole csv, the upload stage only reads it
+    assert results[1]['peak_mb'] > results[2]['peak_mb']
+
+def test_find_regressions():
+    baseline = [
+        {'stage': 'encode', 'mb_per_second': 100.0, 'peak_mb': 20.0},
+        {'stage': 'upload', 'mb_per_second': 50.0, 'peak_mb': 0.5}
+    ]
+    results = [
+        {'stage': 'encode', 'mb_per_second': 90.0, 'peak_mb': 40.0},
+        {'stage': 'upload', 'mb_per_second': 30.0, 'peak_mb': 1.2}
+    ]
+    assert find_regressions(results, baseline, 0.2) == [
+        'encode: peak 40.0 MB, baseline 20.0 MB',
+        'upload: 30.0 MB/s, baseline 50.0 MB/s'
+    ]
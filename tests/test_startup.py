@@ -0,0 +1,84 @@
+import http.server
+import os
+import subprocess
+import sys
+import threading
+import time
+import pytest
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# client libraries that are imported by the stages that use them, not when run.py is loaded
+CLIENT_MODULES = ['google.cloud.bigquery', 'google.auth', 'mig_dx_api', 'httpx', 'requests', 'pyarrow']
+# cold start budgets, generous enough for a loaded CI machine but well under the cost of eager imports
+IMPORT_BUDGET_SECONDS = 0.3
+FIRST_REQUEST_BUDGET_SECONDS = 2.5
+
+LOADED_CLIENT_MODULES = f'print("loaded:", *[name for name in {CLIENT_MODULES!r} if name in sys.modules])'
+
+def run_python(code: str) -> list[str]:
+    result = subprocess.run([sys.executable, '-c', code], cwd=REPO_DIR, capture_output=True, text=True, timeout=60)
+    assert result.returncode == 0, result.stderr
+    return result.stdout.splitlines()
+
+def test_import_time_budget():
+    code = ('import sys, time\nstart = time.perf_counter()\nimport run\nprint(time.perf_counter() - start)\n'
+        f'{LOADED_CLIENT_MODULES}')
+    # best of three, the first run can include a cold disk cache
+    results = [run_python(code) for _ in range(3)]
+    assert [loaded_modules for _, loaded_modules in results] == ['loaded:'] * 3
+    import_seconds = min(float(seconds) for seconds, _ in results)
+    assert import_seconds < IMPORT_BUDGET_SECONDS
+
+@pytest.mark.parametrize('argv', [['--help'], ['--table_name', 'table']])
+def test_cli_exits_without_client_libraries(argv):
+    code = (f'import runpy, sys\nsys.argv = ["run.py", *{argv!r}]\n'
+        'try:\n    runpy.run_path("run.py", run_name="__main__")\nexcept SystemExit:\n    pass\n'
+        f'{LOADED_CLIENT_MODULES}')
+    assert run_python(code)[-1] == 'loaded:'
+
+class FirstRequestHandler(http.server.BaseHTTPRequestHandler):
+    """
+    Stand-in for the DX api that records when the first request arrives and fails every request
+    """
+    def do_GET(self):
+        self.server.requests.append((time.perf_counter(), self.path))
+        self.send_response(503)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    do_POST = do_GET
+
+    def log_message(self, format, *args):
+        pass
+
+def create_private_key() -> str:
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048).private_bytes(
+        serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption())
+    # Portal removes all linebreaks from secrets
+    return private_key.decode().replace('\n', '')
+
+def test_time_to_first_request_budget(tmp_path):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FirstRequestHandler)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    env = {
+        **os.environ,
+        'APP_ID': 'app_id',
+        'PRIVATE_KEY': create_private_key(),
+        'BASE_URL': f'http://127.0.0.1:{server.server_port}/{{}}'
+    }
+    command = [sys.executable, 'run.py', '--dataset_id', 'dataset', '--table_name', 'table',
+        '--cache_ttl', '0', '--metrics_file', str(tmp_path / 'metrics.json')]
+    try:
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=REPO_DIR, env=env, capture_output=True, text=True, timeout=60)
+    finally:
+        server.shutdown()
+        server.server_close()
+    assert result.returncode != 0
+    first_request_time, path = server.requests[0]
+    assert path == '/auth/me'
+    print(f'time to first request: {first_request_time - start:.3f} seconds')
+    assert first_request_time - start < FIRST_REQUEST_BUDGET_SECONDS